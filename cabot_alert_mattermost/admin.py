@@ -0,0 +1,25 @@
+from django.contrib import admin
+
+from cabot_alert_mattermost.models import MatterMostChannelDigest, MatterMostInstanceSettings, MatterMostMessageTemplate, \
+    MatterMostOutboxPost
+
+
+@admin.register(MatterMostInstanceSettings)
+class MatterMostInstanceSettingsAdmin(admin.ModelAdmin):
+    list_display = ('instance', 'max_concurrency', 'async_delivery', 'coalesce_seconds', 'thread_incidents',
+                    'lazy_images', 'persistent_connection')
+
+
+@admin.register(MatterMostMessageTemplate)
+class MatterMostMessageTemplateAdmin(admin.ModelAdmin):
+    list_display = ('kind', 'instance', 'service')
+
+
+@admin.register(MatterMostChannelDigest)
+class MatterMostChannelDigestAdmin(admin.ModelAdmin):
+    list_display = ('instance', 'channel_id', 'window_seconds')
+
+
+@admin.register(MatterMostOutboxPost)
+class MatterMostOutboxPostAdmin(admin.ModelAdmin):
+    list_display = ('instance', 'channel_id', 'attempts', 'next_attempt', 'created')
@@ -0,0 +1,226 @@
+"""
+Benchmarks for the alert hot path. Run them with `python manage.py mattermost_benchmark`.
+"""
+import time
+import timeit
+from contextlib import contextmanager
+
+from django.contrib.auth.models import User
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+from django.template import Context, Template
+from django.utils import timezone
+
+from cabot.cabotapp.models import HttpStatusCheck, Service, StatusCheckResult, UserProfile
+from cabot.cabotapp.models_plugins import MatterMostInstance
+from cabot_alert_mattermost import client, models
+from cabot_alert_mattermost.fake_server import FakeMatterMostServer
+
+
+class _FakeResult(object):
+    def __init__(self, i):
+        self.error = 'Check {} failed: value 123.4 > 100'.format(i)
+        self.job_number = i
+
+
+class _FakeCheck(object):
+    check_category = 'Metric check'
+
+    def __init__(self, i):
+        self.id = i
+        self.name = 'Check {}'.format(i)
+        self.last_result = _FakeResult(i)
+
+
+class _FakeService(object):
+    def __init__(self, num_checks):
+        self.id = 1
+        self.name = 'Benchmark service'
+        self._checks = [_FakeCheck(i) for i in range(1, num_checks + 1)]
+
+    def all_failing_checks(self):
+        return self._checks
+
+
+def _template_context(num_checks):
+    service = _FakeService(num_checks)
+    return Context({
+        'service': service,
+        'failing_checks': [(check, check.last_result) for check in service.all_failing_checks()],
+        'users': ['user{}'.format(i) for i in range(5)],
+        'missing_aliases': [('Some One', 'http://localhost/user/1/profile/MatterMost%20Plugin')],
+        'host': 'localhost',
+        'scheme': 'http',
+        'alert': True,
+        'jenkins_api': 'http://jenkins/',
+        'status': 'ERROR',
+        'emoji': models.EMOJIS['ERROR'],
+    })
+
+
+def benchmark_templates(num_checks=(1, 10, 50), iterations=200):
+    """
+    Compare rendering the alert message by parsing the template on every alert (the old behaviour) against
+    rendering the precompiled template.
+    :return: list of (num_checks, seconds per render uncompiled, seconds per render precompiled) tuples
+    """
+    results = []
+    for n in num_checks:
+        context = _template_context(n)
+        uncompiled = timeit.timeit(lambda: Template(models.MESSAGE_TEMPLATE_ALERT).render(context),
+                                   number=iterations) / iterations
+        compiled = timeit.timeit(lambda: models._compile_template(models.MESSAGE_TEMPLATE_ALERT).render(context),
+                                 number=iterations) / iterations
+        results.append((n, uncompiled, compiled))
+    return results
+
+
+class _Rollback(Exception):
+    pass
+
+
+def _percentile(values, percent):
+    values = sorted(values)
+    return values[int(round((len(values) - 1) * percent / 100.0))]
+
+
+def _create_alert_fixtures(server, num_services, num_users, num_checks, max_concurrency):
+    """Create a MM instance pointing at the fake server, and services with failing checks and users to alert."""
+    instance = MatterMostInstance.objects.create(name='Benchmark MM instance', server_url=server.url,
+                                                 api_token='BENCHMARK-TOKEN', default_channel_id='benchmark')
+    models.MatterMostInstanceSettings.objects.create(instance=instance, max_concurrency=max_concurrency)
+
+    users = []
+    for i in range(num_users):
+        user = User.objects.create(username='mattermost-benchmark-{}'.format(i))
+        profile = UserProfile.objects.get_or_create(user=user)[0]
+        models.MatterMostAlertUserData.objects.create(user=profile, mattermost_alias='benchmark{}'.format(i))
+        users.append(user)
+
+    services = []
+    for i in range(num_services):
+        service = Service.objects.create(name='Benchmark service {}'.format(i), mattermost_instance=instance,
+                                         mattermost_channel_id='channel-{}'.format(i % 10))
+        for j in range(num_checks):
+            now = timezone.now()
+            check = HttpStatusCheck.objects.create(name='Benchmark check {}-{}'.format(i, j),
+                                                   endpoint='http://localhost/', importance=Service.ERROR_STATUS,
+                                                   calculated_status='failing', last_run=now)
+            StatusCheckResult.objects.create(status_check=check, time=now, time_complete=now, succeeded=False,
+                                             error='Benchmark check {}-{} failed'.format(i, j))
+            service.status_checks.add(check)
+        service.old_overall_status = Service.PASSING_STATUS
+        service.overall_status = Service.ERROR_STATUS
+        services.append(service)
+    return instance, services, users
+
+
+@contextmanager
+def _fake_mattermost(num_services, num_users, num_checks, latency=0, error_rate=0, image_bytes=20000,
+                     max_concurrency=1, server_version='9.5.0'):
+    """
+    Start a fake Mattermost server, and create an instance pointing at it along with services with failing checks
+    and users to alert, in a transaction that is rolled back afterwards.
+    Status images are replaced with fake ones of image_bytes bytes, and the client's rate limiter is disabled,
+    so the plugin's own cost is measured.
+    :return: (server, services, users) context manager
+    """
+    def render_status_image(check):
+        if not image_bytes:
+            return None
+        # distinct content per check, like real graphs
+        return '{}.png'.format(check.name), (check.name * (image_bytes // len(check.name) + 1))[:image_bytes]
+
+    render_status_image_orig = models._render_status_image
+    models._render_status_image = render_status_image
+    client.reset_clients()
+    models._instance_settings.clear()
+    try:
+        with FakeMatterMostServer(latency=latency, error_rate=error_rate, version=server_version, seed=0) as server:
+            try:
+                with transaction.atomic():
+                    instance, services, users = _create_alert_fixtures(server, num_services, num_users, num_checks,
+                                                                       max_concurrency)
+                    models._get_mm_client_for_instance(instance).rate_limiter = client.TokenBucket(0, 0)
+                    yield server, services, users
+                    raise _Rollback()
+            except _Rollback:
+                pass
+    finally:
+        models._render_status_image = render_status_image_orig
+        client.reset_clients()
+        models._instance_settings.clear()
+
+
+def benchmark_alerts(num_services=50, num_users=5, num_checks=3, rounds=2, latency=0, error_rate=0,
+                     image_bytes=20000, max_concurrency=1, server_version='9.5.0'):
+    """
+    Send alerts for a set of services to a local fake Mattermost server, end to end (DB lookups, template render,
+    channel membership, status images and the post). See _fake_mattermost for the setup.
+    :param num_services: number of services to alert for, each round
+    :param num_users: number of users @mentioned by every alert
+    :param num_checks: number of failing checks per service
+    :param rounds: how many times to alert for every service (later rounds show the steady state, with warm caches)
+    :param latency: seconds the fake server waits before answering each request
+    :param error_rate: fraction of requests the fake server answers with a 503
+    :param image_bytes: size of the fake status image of every check (0 for no images)
+    :param max_concurrency: the instance's max_concurrency setting
+    :param server_version: Mattermost version reported by the fake server
+    :return: dict of alerts, failed (alerts that raised), alerts_per_sec, p50_ms, p99_ms, http_calls_per_alert and
+        db_queries_per_alert
+    """
+    with _fake_mattermost(num_services, num_users, num_checks, latency=latency, error_rate=error_rate,
+                          image_bytes=image_bytes, max_concurrency=max_concurrency,
+                          server_version=server_version) as (server, services, users):
+        plugin = models.MatterMostAlert()
+        durations = []
+        failed = 0
+        requests_before = server.request_count
+        with CaptureQueriesContext(connection) as queries:
+            started = time.time()
+            for _ in range(rounds):
+                for service in services:
+                    alert_started = time.time()
+                    try:
+                        plugin.send_alert(service, users, [])
+                    except Exception:
+                        failed += 1
+                    durations.append(time.time() - alert_started)
+            elapsed = time.time() - started
+        http_calls = server.request_count - requests_before
+
+    alerts = len(durations)
+    return {
+        'alerts': alerts,
+        'failed': failed,
+        'alerts_per_sec': alerts / elapsed,
+        'p50_ms': _percentile(durations, 50) * 1000,
+        'p99_ms': _percentile(durations, 99) * 1000,
+        'http_calls_per_alert': float(http_calls) / alerts,
+        'db_queries_per_alert': float(len(queries)) / alerts,
+    }
+
+
+def benchmark_batch(batch_sizes=(1, 10, 100), num_users=5, num_checks=3, latency=0, image_bytes=20000):
+    """
+    Compare the per alert cost of MatterMostAlert.send_alerts (bulk lookups and rendering, a channel at a time) at
+    different batch sizes, against a local fake Mattermost server (see _fake_mattermost). Each batch is sent once
+    to warm up the caches, then measured.
+    :return: list of (batch size, ms per alert, DB queries per alert, HTTP calls per alert) tuples
+    """
+    results = []
+    with _fake_mattermost(max(batch_sizes), num_users, num_checks, latency=latency,
+                          image_bytes=image_bytes) as (server, services, users):
+        plugin = models.MatterMostAlert()
+        for size in batch_sizes:
+            batch = [(service, users) for service in services[:size]]
+            plugin.send_alerts(batch)
+
+            requests_before = server.request_count
+            with CaptureQueriesContext(connection) as queries:
+                started = time.time()
+                plugin.send_alerts(batch)
+                elapsed = time.time() - started
+            results.append((size, elapsed * 1000 / size, float(len(queries)) / size,
+                            float(server.request_count - requests_before) / size))
+    return results
@@ -0,0 +1,68 @@
+import threading
+import time
+from collections import OrderedDict
+
+from cabot_alert_mattermost import metrics
+
+
+class TTLCache(object):
+    """
+    A small thread safe LRU cache whose entries also expire after a fixed time.
+    Keeps hit/miss counters so we can tell how many lookups (i.e. API round trips) it saves.
+    """
+
+    def __init__(self, max_size, ttl, name=None):
+        """
+        :param max_size: max number of entries; the least recently used entry is evicted when full
+        :param ttl: seconds after which an entry expires
+        :param name: if set, hits/misses are also reported as the cache.<name>.hits/misses metrics
+        """
+        self.name = name
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()  # key -> (expires_at, value), least recently used first
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.pop(key, None)
+            if entry is None or entry[0] <= time.time():
+                self.misses += 1
+                hit = False
+            else:
+                # re-insert to mark as most recently used
+                self._data[key] = entry
+                self.hits += 1
+                hit = True
+        if self.name is not None:
+            metrics.incr('cache.{}.{}'.format(self.name, 'hits' if hit else 'misses'))
+        return entry[1] if hit else default
+
+    def set(self, key, value):
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (time.time() + self.ttl, value)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def delete_where(self, predicate):
+        """Delete all entries whose key matches predicate(key)."""
+        with self._lock:
+            for key in [k for k in self._data if predicate(k)]:
+                del self._data[key]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self)}
+
+    def __len__(self):
+        return len(self._data)
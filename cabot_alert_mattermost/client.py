@@ -0,0 +1,489 @@
+"""
+HTTP client for the Mattermost v4 API.
+
+A single client (wrapping a pooled, keep-alive requests.Session) is kept per Mattermost server/API token, so alerts
+reuse open connections instead of doing fresh TCP+TLS handshakes for every API call.
+Each client also rate limits its calls, and has a circuit breaker that stops non-essential calls while the server is
+failing. Clients for instances with a persistent connection also health check their connection in the background.
+"""
+import logging
+import socket
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+from os import environ as env
+from urlparse import urljoin
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.connection import HTTPConnection
+from requests.packages.urllib3.exceptions import ConnectTimeoutError, NewConnectionError
+
+from cabot_alert_mattermost import metrics
+from cabot_alert_mattermost.cache import TTLCache
+
+logger = logging.getLogger(__name__)
+
+# max number of open connections kept per Mattermost instance
+POOL_SIZE = int(env.get('MATTERMOST_POOL_SIZE', 10))
+
+# (connect, read) timeouts used for every API call, in seconds
+CONNECT_TIMEOUT = float(env.get('MATTERMOST_CONNECT_TIMEOUT', 5))
+READ_TIMEOUT = float(env.get('MATTERMOST_READ_TIMEOUT', 30))
+
+# retries for rate limited (429) and server error (5xx) responses, with exponential backoff
+MAX_RETRIES = int(env.get('MATTERMOST_MAX_RETRIES', 3))
+RETRY_BACKOFF = float(env.get('MATTERMOST_RETRY_BACKOFF', 0.5))
+MAX_RETRY_DELAY = float(env.get('MATTERMOST_MAX_RETRY_DELAY', 30))
+
+RETRY_STATUS_CODES = frozenset([429, 500, 502, 503, 504])
+# non idempotent calls (creating a post) are only retried when the server can't have acted on them: these responses,
+# or failing to connect at all. A 500/502/504 or a dropped connection may come after the post was created.
+NON_IDEMPOTENT_RETRY_STATUS_CODES = frozenset([429, 503])
+
+# how long (seconds) and how many username -> user id mappings and confirmed channel memberships we remember
+USER_CACHE_TTL = int(env.get('MATTERMOST_USER_CACHE_TTL', 3600))
+USER_CACHE_SIZE = int(env.get('MATTERMOST_USER_CACHE_SIZE', 10000))
+
+# how long (seconds) and how many ids of uploaded files that aren't attached to a post yet we remember, so a retried
+# post doesn't upload identical images again
+FILE_CACHE_TTL = int(env.get('MATTERMOST_FILE_CACHE_TTL', 3600))
+FILE_CACHE_SIZE = int(env.get('MATTERMOST_FILE_CACHE_SIZE', 1000))
+
+# oldest Mattermost server version that accepts a list of user_ids when adding channel members
+BULK_CHANNEL_MEMBERS_VERSION = tuple(int(v) for v in
+                                     env.get('MATTERMOST_BULK_CHANNEL_MEMBERS_VERSION', '9.1.0').split('.'))
+
+# how long (seconds) to wait before looking up the server's version again after it couldn't be determined, or
+# before adding channel members in bulk again after the server rejected a bulk add
+CAPABILITY_RETRY_INTERVAL = float(env.get('MATTERMOST_CAPABILITY_RETRY_INTERVAL', 600))
+
+# max API calls per second per Mattermost instance (0 = unlimited), and how many calls can burst above that
+RATE_LIMIT = float(env.get('MATTERMOST_RATE_LIMIT', 10))
+RATE_LIMIT_BURST = int(env.get('MATTERMOST_RATE_LIMIT_BURST', 20))
+
+# the circuit breaker opens after this many consecutive failed calls, and lets a probe through after the timeout
+BREAKER_FAILURE_THRESHOLD = int(env.get('MATTERMOST_BREAKER_FAILURE_THRESHOLD', 5))
+BREAKER_RESET_TIMEOUT = float(env.get('MATTERMOST_BREAKER_RESET_TIMEOUT', 30))
+
+# default max number of API calls/status image renders an alert runs in parallel (1 = run everything serially)
+MAX_CONCURRENCY = int(env.get('MATTERMOST_MAX_CONCURRENCY', 1))
+
+
+# with a persistent connection, how often (seconds) the connection is health checked, which also keeps it from being
+# closed for idling (Mattermost's default idle timeout is 60s)
+KEEPALIVE_INTERVAL = float(env.get('MATTERMOST_KEEPALIVE_INTERVAL', 20))
+
+
+class MatterMostUnavailable(requests.RequestException):
+    """Raised instead of making a call while the circuit breaker for a Mattermost instance is open."""
+
+
+class TokenBucket(object):
+    """
+    Token bucket rate limiter: allows `rate` calls per second on average, with bursts of up to `burst` calls.
+    """
+
+    def __init__(self, rate, burst):
+        # floats, so refills and waits aren't truncated by integer division
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self._tokens = self.burst
+        self._updated = time.time()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Take a token, waiting for one to become available if needed."""
+        if self.rate <= 0:
+            return
+        with self._lock:
+            now = time.time()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            # take the token now (possibly going negative), so callers queue up fairly
+            self._tokens -= 1
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0
+        if wait > 0:
+            metrics.timing('rate_limiter.wait', wait * 1000)
+            time.sleep(wait)
+
+
+class CircuitBreaker(object):
+    """
+    Trips (opens) after `failure_threshold` consecutive failures. While open, every call is refused; after
+    `reset_timeout` seconds it goes half open, and lets essential calls through as probes (non-essential calls are
+    still refused). A successful call closes it again, a failed one re-opens it.
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, name, failure_threshold, reset_timeout):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._state = self.CLOSED
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        with self._lock:
+            if self._state == self.OPEN and time.time() - self.opened_at >= self.reset_timeout:
+                self._set_state(self.HALF_OPEN)
+            return self._state
+
+    def allow(self, essential=False):
+        state = self.state
+        return state == self.CLOSED or (state == self.HALF_OPEN and essential)
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            if self._state != self.CLOSED:
+                self._set_state(self.CLOSED)
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self._state == self.HALF_OPEN or \
+                    (self._state == self.CLOSED and self.failures >= self.failure_threshold):
+                self.opened_at = time.time()
+                self._set_state(self.OPEN)
+
+    def _set_state(self, state):
+        logger.warn('Circuit breaker for %s: %s -> %s (%s consecutive failures)',
+                    self.name, self._state, state, self.failures)
+        self._state = state
+
+
+class KeepAliveAdapter(HTTPAdapter):
+    """HTTPAdapter whose connections have TCP keepalive turned on, so connections that died while idle are noticed."""
+
+    def init_poolmanager(self, *args, **kwargs):
+        kwargs['socket_options'] = HTTPConnection.default_socket_options + [
+            (socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)]
+        super(KeepAliveAdapter, self).init_poolmanager(*args, **kwargs)
+
+
+class ConnectionKeeper(threading.Thread):
+    """
+    Keeps a client's connection to its Mattermost server open and healthy: pings the server every `interval`
+    seconds through the client's session, so its keep-alive connection never idles long enough to be closed by the
+    server or a load balancer. If a ping fails, the client's connections are dropped, so the next call reconnects
+    instead of failing on a dead connection.
+    Pings aren't rate limited or counted by the circuit breaker.
+    """
+
+    def __init__(self, client, interval):
+        super(ConnectionKeeper, self).__init__(name='mattermost-keepalive {}'.format(client.api_url))
+        self.daemon = True
+        self.client = client
+        self.interval = interval
+        # result of the last health check (None until the first one)
+        self.healthy = None
+        self._stopped = threading.Event()
+
+    def run(self):
+        # connect right away, so the first alert doesn't have to
+        self.check()
+        while not self._stopped.wait(self.interval):
+            self.check()
+
+    def check(self):
+        """:return: whether the server answered the health check"""
+        metrics.incr('keepalive.pings')
+        try:
+            response = self.client.session.get(urljoin(self.client.api_url, 'system/ping'),
+                                               timeout=self.client.timeout)
+            healthy = response.status_code == 200
+        except requests.RequestException:
+            logger.debug('Health check of %s failed.', self.client.api_url, exc_info=True)
+            healthy = False
+
+        if not healthy:
+            if self.healthy is not False:
+                logger.warn('Health check of %s failed, reconnecting.', self.client.api_url)
+            metrics.incr('keepalive.reconnects')
+            self.client.reconnect()
+        elif self.healthy is False:
+            logger.warn('Health check of %s succeeded again.', self.client.api_url)
+        self.healthy = healthy
+        return healthy
+
+    def stop(self):
+        self._stopped.set()
+
+
+class MatterMostClient(object):
+    """
+    Talks to a single Mattermost instance. Thread safe, so one client can be shared by all alerts for an instance.
+    """
+
+    def __init__(self, api_url, headers, pool_size=POOL_SIZE, timeout=(CONNECT_TIMEOUT, READ_TIMEOUT),
+                 max_retries=MAX_RETRIES, retry_backoff=RETRY_BACKOFF, max_concurrency=MAX_CONCURRENCY,
+                 keepalive_interval=None):
+        """
+        :param api_url: MM api v4 endpoint
+        :param headers: HTTP headers (w/ api token) sent with every request
+        :param pool_size: max number of connections to keep open to the server
+        :param timeout: default requests timeout for every call, as a (connect, read) tuple
+        :param max_retries: how many times to retry a request that was rate limited or hit a server error
+        :param retry_backoff: base delay between retries, doubled after every attempt
+        :param max_concurrency: max number of threads used by map() (shared by all alerts for this instance)
+        :param keepalive_interval: if set, keep a persistent connection to the server, health checked every
+                                   keepalive_interval seconds (see ConnectionKeeper)
+        """
+        self.api_url = api_url
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self.max_concurrency = max_concurrency
+        self.keepalive_interval = keepalive_interval
+        self._pool = None
+        self._pool_lock = threading.Lock()
+        self._server_version = None
+        self._server_version_retry_at = 0
+        # whether the server supports adding several users to a channel at once (None until we know)
+        self.bulk_channel_members = None
+        self._bulk_channel_members_paused_until = 0
+
+        self.rate_limiter = TokenBucket(RATE_LIMIT, RATE_LIMIT_BURST)
+        self.breaker = CircuitBreaker(api_url, BREAKER_FAILURE_THRESHOLD, BREAKER_RESET_TIMEOUT)
+
+        self.session = requests.Session()
+        self.session.headers.update(headers)
+        adapter_class = KeepAliveAdapter if keepalive_interval else HTTPAdapter
+        self._adapter = adapter_class(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('https://', self._adapter)
+        self.session.mount('http://', self._adapter)
+
+        # lowercase username -> user id (or None if the username doesn't exist on this server)
+        self.user_ids = TTLCache(USER_CACHE_SIZE, USER_CACHE_TTL, name='user_ids')
+        # (channel_id, user_id) -> True, for users we know are members of a channel
+        self.channel_members = TTLCache(USER_CACHE_SIZE, USER_CACHE_TTL, name='channel_members')
+        # (channel_id, sha1 of the file's content) -> MM file id, for uploaded files that aren't attached to a post yet
+        self.file_ids = TTLCache(FILE_CACHE_SIZE, FILE_CACHE_TTL, name='file_ids')
+
+        self.keeper = None
+        if keepalive_interval:
+            self.keeper = ConnectionKeeper(self, keepalive_interval)
+            self.keeper.start()
+
+    def request(self, method, path, essential=False, idempotent=True, **kwargs):
+        # type: (str, str, bool, bool, ...) -> requests.Response
+        """
+        Make a request against the API, retrying with backoff if the server is rate limiting us or erroring.
+        :param method: HTTP method
+        :param path: path relative to the api v4 endpoint, e.g. 'posts'
+        :param essential: whether the call is essential (i.e. the alert post itself), and may be used to probe a
+                          half open circuit breaker
+        :param idempotent: whether the call can safely be made twice. Calls that can't (e.g. creating a post, which
+                           would post a duplicate) are only retried if the server can't have acted on them
+        :param kwargs: passed through to requests
+        :return: the last response received (the caller should still check its status)
+        :raises MatterMostUnavailable: if the circuit breaker doesn't allow the call
+        """
+        if not self.breaker.allow(essential):
+            metrics.incr('http.rejected')
+            raise MatterMostUnavailable('Circuit breaker for {} is {}, not calling {}'.format(
+                self.api_url, self.breaker.state, path))
+
+        kwargs.setdefault('timeout', self.timeout)
+        url = urljoin(self.api_url, path)
+
+        try:
+            response = self._request_with_retries(method, url, idempotent, **kwargs)
+        except (requests.ConnectionError, requests.Timeout):
+            metrics.incr('http.failures')
+            self.breaker.record_failure()
+            raise
+        if response.status_code in RETRY_STATUS_CODES:
+            metrics.incr('http.failures')
+            self.breaker.record_failure()
+        else:
+            self.breaker.record_success()
+        return response
+
+    def _request_with_retries(self, method, url, idempotent, **kwargs):
+        retry_status_codes = RETRY_STATUS_CODES if idempotent else NON_IDEMPOTENT_RETRY_STATUS_CODES
+        attempt = 0
+        while True:
+            self.rate_limiter.acquire()
+            metrics.incr('http.calls')
+            try:
+                response = self.session.request(method, url, **kwargs)
+            except requests.ConnectionError as e:
+                if attempt >= self.max_retries or not (idempotent or _failed_to_connect(e)):
+                    raise
+                delay = self._backoff(attempt)
+                logger.warn('Connection to %s failed, retrying in %.1fs', url, delay, exc_info=True)
+            else:
+                if response.status_code not in retry_status_codes or attempt >= self.max_retries:
+                    return response
+                delay = self._retry_delay(response, attempt)
+                logger.warn('%s %s returned %s, retrying in %.1fs', method, url, response.status_code, delay)
+
+            metrics.incr('http.retries')
+            time.sleep(delay)
+            attempt += 1
+
+    def post(self, path, **kwargs):
+        return self.request('POST', path, **kwargs)
+
+    def put(self, path, **kwargs):
+        return self.request('PUT', path, **kwargs)
+
+    def get(self, path, **kwargs):
+        return self.request('GET', path, **kwargs)
+
+    def server_version(self):
+        """
+        :return: the server's version as a tuple of ints, e.g. (9, 5, 0), or None if it couldn't be determined.
+                 Looked up once per client (or again after CAPABILITY_RETRY_INTERVAL, if it couldn't be determined).
+        """
+        if self._server_version is None and time.time() >= self._server_version_retry_at:
+            try:
+                response = self.get('system/ping')
+                # looks like "9.5.0.9.5.0.<build hash>.<enterprise>"
+                self._server_version = tuple(int(v) for v in response.headers['X-Version-Id'].split('.')[:3])
+            except (requests.RequestException, KeyError, ValueError):
+                logger.warn('Could not determine the version of %s', self.api_url, exc_info=True)
+                self._server_version_retry_at = time.time() + CAPABILITY_RETRY_INTERVAL
+        return self._server_version
+
+    def supports_bulk_channel_members(self):
+        """:return: whether the server accepts a list of user_ids when adding channel members"""
+        if time.time() < self._bulk_channel_members_paused_until:
+            return False
+        if self.bulk_channel_members is None:
+            version = self.server_version()
+            if version is None:
+                return False
+            self.bulk_channel_members = version >= BULK_CHANNEL_MEMBERS_VERSION
+        return self.bulk_channel_members
+
+    def pause_bulk_channel_members(self):
+        """
+        Don't add channel members in bulk for CAPABILITY_RETRY_INTERVAL, e.g. because the server rejected a bulk add
+        (which may have been caused by the request rather than a lack of support).
+        """
+        self._bulk_channel_members_paused_until = time.time() + CAPABILITY_RETRY_INTERVAL
+
+    def map(self, func, items):
+        """
+        Like map(func, items), but runs up to max_concurrency calls in parallel. Results are returned in order, and the
+        first exception raised by func is re-raised.
+        Don't call map() from within func, the thread pool is bounded and that can deadlock.
+        """
+        items = list(items)
+        if self.max_concurrency <= 1 or len(items) <= 1:
+            return [func(item) for item in items]
+        return self._get_pool().map(metrics.propagate(func), items)
+
+    def reconnect(self):
+        """Drop all open connections to the server; the next calls open new ones."""
+        self._adapter.close()
+
+    def close(self):
+        if self.keeper is not None:
+            self.keeper.stop()
+        self.session.close()
+        with self._pool_lock:
+            if self._pool is not None:
+                self._pool.close()
+                self._pool = None
+
+    def forget_channel(self, channel_id):
+        """Forget cached memberships for a channel, e.g. after we were denied access to it."""
+        self.channel_members.delete_where(lambda key: key[0] == channel_id)
+
+    def cache_stats(self):
+        return {
+            'user_ids': self.user_ids.stats(),
+            'channel_members': self.channel_members.stats(),
+            'file_ids': self.file_ids.stats(),
+        }
+
+    def _get_pool(self):
+        with self._pool_lock:
+            if self._pool is None:
+                self._pool = ThreadPool(self.max_concurrency)
+            return self._pool
+
+    def _backoff(self, attempt):
+        return min(self.retry_backoff * (2 ** attempt), MAX_RETRY_DELAY)
+
+    def _retry_delay(self, response, attempt):
+        """Backoff delay, but wait at least as long as Mattermost's rate limiter asks us to."""
+        delay = self._backoff(attempt)
+        if response.status_code == 429:
+            for header in ('Retry-After', 'X-RateLimit-Reset'):
+                try:
+                    delay = max(delay, float(response.headers[header]))
+                    break
+                except (KeyError, TypeError, ValueError):
+                    continue
+        return min(delay, MAX_RETRY_DELAY)
+
+
+def _failed_to_connect(error):
+    # type: (requests.ConnectionError) -> bool
+    """:return: whether the request failed before it was sent (so the server can't have acted on it)"""
+    if isinstance(error, requests.ConnectTimeout):
+        return True
+    reason = getattr(error.args[0], 'reason', None) if error.args else None
+    return isinstance(reason, (NewConnectionError, ConnectTimeoutError))
+
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def get_client(api_url, headers, options=None):
+    # type: (str, dict, dict) -> MatterMostClient
+    """
+    Get the shared client for a Mattermost instance, creating it if needed.
+    :param api_url: MM api v4 endpoint
+    :param headers: HTTP headers (w/ api token)
+    :param options: kwargs for MatterMostClient. If the shared client was created with different ones (e.g. the
+                    instance's settings were changed), it's replaced with a new client using these.
+    """
+    key = (api_url, headers.get('Authorization'))
+    replaced = None
+    with _clients_lock:
+        client = _clients.get(key)
+        if client is not None and options is not None and \
+                any(getattr(client, name) != value for name, value in options.items()):
+            replaced = client
+            client = None
+        if client is None:
+            client = _clients[key] = MatterMostClient(api_url, headers, **(options or {}))
+    if replaced is not None:
+        logger.info('Settings for %s changed, replacing its client.', api_url)
+        replaced.close()
+    return client
+
+
+def forget_client(api_url, headers):
+    """Close and forget the client for an instance, e.g. because its settings changed."""
+    with _clients_lock:
+        client = _clients.pop((api_url, headers.get('Authorization')), None)
+    if client is not None:
+        client.close()
+
+
+def breaker_states():
+    """:return: {api url: circuit breaker state} for every client, e.g. to show during incidents"""
+    with _clients_lock:
+        clients = list(_clients.values())
+    return dict((client.api_url, client.breaker.state) for client in clients)
+
+
+def reset_clients():
+    """Close and forget all clients (their connection pools will be recreated on next use)."""
+    with _clients_lock:
+        for client in _clients.values():
+            client.close()
+        _clients.clear()
@@ -0,0 +1,163 @@
+"""
+A local stand-in for the parts of the Mattermost API the plugin uses, for benchmarks.
+Serves system/ping, users/usernames, channels/{id}/members, files, posts and posts/{id}/patch, with configurable
+latency and error rate, and counts the requests it gets.
+"""
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+from urlparse import urlparse
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class _Handler(BaseHTTPRequestHandler):
+    # keep-alive, like a real Mattermost server
+    protocol_version = 'HTTP/1.1'
+
+    # (method, path regex, handler method name)
+    routes = [
+        ('GET', r'^/api/v4/system/ping$', '_ping'),
+        ('POST', r'^/api/v4/users/usernames$', '_users_by_usernames'),
+        ('POST', r'^/api/v4/channels/(?P<channel_id>[^/]+)/members$', '_add_channel_members'),
+        ('POST', r'^/api/v4/files$', '_upload_file'),
+        ('POST', r'^/api/v4/posts$', '_create_post'),
+        ('PUT', r'^/api/v4/posts/(?P<post_id>[^/]+)/patch$', '_patch_post'),
+    ]
+
+    def do_GET(self):
+        self._handle('GET')
+
+    def do_POST(self):
+        self._handle('POST')
+
+    def do_PUT(self):
+        self._handle('PUT')
+
+    def log_message(self, format, *args):
+        pass
+
+    def _handle(self, method):
+        server = self.server.fake
+        body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        path = urlparse(self.path).path
+        server.record_request(method, path)
+
+        if server.latency:
+            time.sleep(server.latency)
+        if server.should_fail():
+            return self._respond(503, {'message': 'fake server error'})
+
+        for route_method, pattern, handler in self.routes:
+            match = re.match(pattern, path)
+            if route_method == method and match:
+                return getattr(self, handler)(body, **match.groupdict())
+        self._respond(404, {'message': 'not found'})
+
+    def _respond(self, status_code, data, headers=None):
+        content = json.dumps(data)
+        self.send_response(status_code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(content)
+
+    def _ping(self, body):
+        self._respond(200, {'status': 'OK'}, {'X-Version-Id': self.server.fake.version})
+
+    def _users_by_usernames(self, body):
+        # every username exists, except ones starting with 'missing'
+        self._respond(200, [{'id': 'id-' + username, 'username': username}
+                            for username in json.loads(body) if not username.startswith('missing')])
+
+    def _add_channel_members(self, body, channel_id):
+        data = json.loads(body)
+        if 'user_ids' in data:
+            return self._respond(201, [{'channel_id': channel_id, 'user_id': user_id} for user_id in data['user_ids']])
+        self._respond(201, {'channel_id': channel_id, 'user_id': data['user_id']})
+
+    def _upload_file(self, body):
+        self._respond(201, {'file_infos': [{'id': uuid.uuid4().hex, 'size': len(body)}]})
+
+    def _create_post(self, body):
+        post = json.loads(body)
+        post['id'] = uuid.uuid4().hex
+        self._respond(201, post)
+
+    def _patch_post(self, body, post_id):
+        post = json.loads(body)
+        post['id'] = post_id
+        self._respond(200, post)
+
+
+class FakeMatterMostServer(object):
+    """
+    Runs the fake API in a background thread, on a free local port:
+
+        with FakeMatterMostServer(latency=0.01, error_rate=0.05) as server:
+            ... point a MatterMostInstance at server.url ...
+            print server.request_count
+    """
+
+    def __init__(self, latency=0, error_rate=0, version='9.5.0', seed=None):
+        """
+        :param latency: seconds to wait before answering each request
+        :param error_rate: fraction (0-1) of requests answered with a 503
+        :param version: server version reported by system/ping (decides whether users are added in bulk)
+        :param seed: seed for picking which requests fail
+        """
+        self.latency = latency
+        self.error_rate = error_rate
+        self.version = version
+        self.requests = {}  # (method, path) -> count
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._httpd = None
+        self._thread = None
+
+    @property
+    def url(self):
+        """:return: the server URL, to use as a MatterMostInstance's server_url"""
+        host, port = self._httpd.server_address
+        return 'http://{}:{}/'.format(host, port)
+
+    @property
+    def request_count(self):
+        with self._lock:
+            return sum(self.requests.values())
+
+    def record_request(self, method, path):
+        with self._lock:
+            self.requests[(method, path)] = self.requests.get((method, path), 0) + 1
+
+    def should_fail(self):
+        with self._lock:
+            return self._random.random() < self.error_rate
+
+    def start(self):
+        self._httpd = _ThreadingHTTPServer(('127.0.0.1', 0), _Handler)
+        self._httpd.fake = self
+        self._thread = threading.Thread(target=self._httpd.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+        self._thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
@@ -0,0 +1,51 @@
+from django.core.management.base import BaseCommand
+
+from cabot_alert_mattermost import benchmarks
+
+
+class Command(BaseCommand):
+    help = 'Benchmark the Mattermost alert plugin hot path.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('benchmark', choices=['templates', 'alerts', 'batch'], help='Which benchmark to run.')
+        parser.add_argument('--iterations', type=int, default=200, help='Iterations per measurement.')
+        # alerts benchmark
+        parser.add_argument('--services', type=int, default=50, help='Services to alert for, per round.')
+        parser.add_argument('--users', type=int, default=5, help='Users @mentioned per alert.')
+        parser.add_argument('--checks', type=int, default=3, help='Failing checks per service.')
+        parser.add_argument('--rounds', type=int, default=2, help='Alerts per service.')
+        parser.add_argument('--latency', type=float, default=0, help='Fake server latency per request (seconds).')
+        parser.add_argument('--error-rate', type=float, default=0, help='Fraction of requests failed with a 503.')
+        parser.add_argument('--image-bytes', type=int, default=20000, help='Status image size (0 for no images).')
+        parser.add_argument('--max-concurrency', type=int, default=1, help='The instance\'s max_concurrency.')
+        parser.add_argument('--server-version', default='9.5.0', help='Mattermost version of the fake server.')
+
+    def handle(self, *args, **options):
+        getattr(self, '_bench_' + options['benchmark'])(options)
+
+    def _bench_templates(self, options):
+        self.stdout.write('{:>8} {:>16} {:>16} {:>8}'.format('checks', 'uncompiled (ms)', 'compiled (ms)', 'speedup'))
+        for n, uncompiled, compiled in benchmarks.benchmark_templates(iterations=options['iterations']):
+            self.stdout.write('{:>8} {:>16.3f} {:>16.3f} {:>7.1f}x'.format(
+                n, uncompiled * 1000, compiled * 1000, uncompiled / compiled))
+
+    def _bench_alerts(self, options):
+        results = benchmarks.benchmark_alerts(num_services=options['services'], num_users=options['users'],
+                                              num_checks=options['checks'], rounds=options['rounds'],
+                                              latency=options['latency'], error_rate=options['error_rate'],
+                                              image_bytes=options['image_bytes'],
+                                              max_concurrency=options['max_concurrency'],
+                                              server_version=options['server_version'])
+        self.stdout.write('{alerts} alerts ({failed} failed)\n'
+                          '{alerts_per_sec:.1f} alerts/sec\n'
+                          'p50 {p50_ms:.1f} ms, p99 {p99_ms:.1f} ms\n'
+                          '{http_calls_per_alert:.1f} HTTP calls/alert\n'
+                          '{db_queries_per_alert:.1f} DB queries/alert'.format(**results))
+
+    def _bench_batch(self, options):
+        self.stdout.write('{:>8} {:>16} {:>16} {:>16}'.format('batch', 'ms/alert', 'queries/alert', 'HTTP calls/alert'))
+        for size, ms, queries, http_calls in benchmarks.benchmark_batch(num_users=options['users'],
+                                                                        num_checks=options['checks'],
+                                                                        latency=options['latency'],
+                                                                        image_bytes=options['image_bytes']):
+            self.stdout.write('{:>8} {:>16.2f} {:>16.1f} {:>16.1f}'.format(size, ms, queries, http_calls))
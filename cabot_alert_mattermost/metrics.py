@@ -0,0 +1,219 @@
+"""
+Metrics for the alert pipeline.
+
+Counters and timings are sent to a pluggable backend, chosen with the MATTERMOST_METRICS_BACKEND environment variable
+(dotted path to a backend class, see the backends below). Each alert also gets an AlertTimer, which collects the time
+spent in each stage of the alert and its counters (HTTP calls, retries, bytes uploaded, cache hits...), and logs them
+as one line when the alert is done.
+"""
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from importlib import import_module
+from os import environ as env
+
+logger = logging.getLogger(__name__)
+
+METRICS_BACKEND = env.get('MATTERMOST_METRICS_BACKEND', 'cabot_alert_mattermost.metrics.NullBackend')
+
+# all metric names start with this
+PREFIX = 'mattermost'
+
+
+class NullBackend(object):
+    """Discards everything (the default)."""
+
+    def incr(self, name, value=1):
+        pass
+
+    def timing(self, name, ms):
+        pass
+
+
+class InMemoryBackend(object):
+    """Keeps totals of counters and lists of timings in memory, for tests."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = {}
+        self.timings = {}
+
+    def incr(self, name, value=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def timing(self, name, ms):
+        with self._lock:
+            self.timings.setdefault(name, []).append(ms)
+
+
+class StatsdBackend(object):
+    """Sends metrics to statsd (needs the statsd package). Configured with STATSD_HOST, STATSD_PORT, STATSD_PREFIX."""
+
+    def __init__(self):
+        import statsd
+        self.client = statsd.StatsClient(env.get('STATSD_HOST', 'localhost'), int(env.get('STATSD_PORT', 8125)),
+                                         prefix=env.get('STATSD_PREFIX', 'cabot'))
+
+    def incr(self, name, value=1):
+        self.client.incr(name, value)
+
+    def timing(self, name, ms):
+        self.client.timing(name, ms)
+
+
+class PrometheusBackend(object):
+    """
+    Exposes metrics through prometheus_client's default registry (needs the prometheus_client package): counters
+    become Counters and timings become Histograms (in seconds), with dots replaced by underscores.
+    """
+
+    def __init__(self):
+        import prometheus_client
+        self._prometheus = prometheus_client
+        self._lock = threading.Lock()
+        self._metrics = {}
+
+    def _get(self, cls, name, suffix=''):
+        name = name.replace('.', '_') + suffix
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(name, name)
+        return metric
+
+    def incr(self, name, value=1):
+        self._get(self._prometheus.Counter, name, '_total').inc(value)
+
+    def timing(self, name, ms):
+        self._get(self._prometheus.Histogram, name, '_seconds').observe(ms / 1000.0)
+
+
+_backend = []
+_backend_lock = threading.Lock()
+
+
+def get_backend():
+    """:return: the configured metrics backend (created on first use)"""
+    if not _backend:
+        with _backend_lock:
+            if not _backend:
+                module_name, class_name = METRICS_BACKEND.rsplit('.', 1)
+                try:
+                    backend = getattr(import_module(module_name), class_name)()
+                except Exception:
+                    logger.exception('Could not create metrics backend %s, metrics are disabled.', METRICS_BACKEND)
+                    backend = NullBackend()
+                _backend.append(backend)
+    return _backend[0]
+
+
+def set_backend(backend):
+    """Replace the metrics backend, e.g. with an InMemoryBackend in tests."""
+    with _backend_lock:
+        del _backend[:]
+        _backend.append(backend)
+
+
+class AlertTimer(object):
+    """
+    Collects the stage timings and counters of a single alert.
+    """
+
+    def __init__(self, name):
+        """
+        :param name: what the alert is for (e.g. the service name), used in the log line
+        """
+        self.name = name
+        self.outcome = 'skipped'
+        self.started = time.time()
+        self.stages = {}
+        self.counters = {}
+        self._lock = threading.Lock()
+
+    def add_stage(self, stage, ms):
+        with self._lock:
+            self.stages[stage] = self.stages.get(stage, 0) + ms
+
+    def add_count(self, name, value):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def summary(self):
+        """:return: the alert's breakdown as a 'key=value ...' string"""
+        fields = [('alert', u'"{}"'.format(self.name)), ('outcome', self.outcome),
+                  ('total_ms', '{:.1f}'.format((time.time() - self.started) * 1000))]
+        fields += [(stage + '_ms', '{:.1f}'.format(ms)) for stage, ms in sorted(self.stages.items())]
+        fields += sorted(self.counters.items())
+        return u' '.join(u'{}={}'.format(k, v) for k, v in fields)
+
+
+_local = threading.local()
+
+
+def current_alert():
+    """:return: the AlertTimer of the alert being processed by this thread, if any"""
+    return getattr(_local, 'alert', None)
+
+
+@contextmanager
+def alert_timer(name):
+    """
+    Time an alert: stages and counters recorded in this thread (or in functions wrapped with propagate()) while
+    the context is active are added to the alert's AlertTimer, which is logged when the context exits.
+    Set the timer's outcome to something other than 'skipped' if the alert did something worth logging.
+    """
+    timer = AlertTimer(name)
+    previous = current_alert()
+    _local.alert = timer
+    try:
+        yield timer
+    except Exception:
+        timer.outcome = 'failed'
+        raise
+    finally:
+        _local.alert = previous
+        timing('alert.' + timer.outcome, (time.time() - timer.started) * 1000)
+        logger.log(logging.DEBUG if timer.outcome == 'skipped' else logging.INFO, timer.summary())
+
+
+def propagate(func):
+    """Wrap a function that will run in another thread, so it records metrics to the current alert."""
+    alert = current_alert()
+
+    def wrapper(*args, **kwargs):
+        previous = current_alert()
+        _local.alert = alert
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _local.alert = previous
+    return wrapper
+
+
+def incr(name, value=1):
+    """Increment a counter, for the backend and for the current alert."""
+    get_backend().incr('{}.{}'.format(PREFIX, name), value)
+    alert = current_alert()
+    if alert is not None:
+        alert.add_count(name.replace('.', '_'), value)
+
+
+def timing(name, ms):
+    """Record a timing (in milliseconds) to the backend."""
+    get_backend().timing('{}.{}'.format(PREFIX, name), ms)
+
+
+@contextmanager
+def stage(name):
+    """Time a stage of the alert pipeline, for the backend and for the current alert."""
+    started = time.time()
+    try:
+        yield
+    finally:
+        ms = (time.time() - started) * 1000
+        timing('stage.' + name, ms)
+        alert = current_alert()
+        if alert is not None:
+            alert.add_stage(name, ms)
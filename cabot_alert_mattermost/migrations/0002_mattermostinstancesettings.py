@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cabotapp', '0001_initial'),
+        ('cabot_alert_mattermost', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MatterMostInstanceSettings',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('max_concurrency', models.PositiveIntegerField(default=1, help_text='Max number of API calls/status image renders run in parallel for this instance (1 = serial).')),
+                ('instance', models.OneToOneField(related_name='alert_settings', to='cabotapp.MatterMostInstance', on_delete=django.db.models.deletion.CASCADE)),
+            ],
+        ),
+    ]
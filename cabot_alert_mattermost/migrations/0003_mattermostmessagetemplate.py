@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+import django.db.models.deletion
+import cabot_alert_mattermost.models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cabotapp', '0001_initial'),
+        ('cabot_alert_mattermost', '0002_mattermostinstancesettings'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MatterMostMessageTemplate',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('kind', models.CharField(max_length=10, choices=[('normal', 'Back to normal'), ('alert', 'Alert')])),
+                ('template', models.TextField(validators=[cabot_alert_mattermost.models.validate_message_template])),
+                ('instance', models.ForeignKey(blank=True, to='cabotapp.MatterMostInstance', help_text='Use this template for all services alerting to this instance.', null=True, on_delete=django.db.models.deletion.CASCADE)),
+                ('service', models.ForeignKey(blank=True, to='cabotapp.Service', help_text='Use this template for this service only (takes precedence).', null=True, on_delete=django.db.models.deletion.CASCADE)),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='mattermostmessagetemplate',
+            unique_together=set([('kind', 'instance', 'service')]),
+        ),
+    ]
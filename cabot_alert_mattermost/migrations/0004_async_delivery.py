@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cabotapp', '0001_initial'),
+        ('cabot_alert_mattermost', '0003_mattermostmessagetemplate'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='mattermostinstancesettings',
+            name='async_delivery',
+            field=models.BooleanField(default=False, help_text='Deliver alerts from a celery task instead of from the check run, coalescing alerts for the same channel into a single post.'),
+        ),
+        migrations.AddField(
+            model_name='mattermostinstancesettings',
+            name='coalesce_seconds',
+            field=models.PositiveIntegerField(default=10, help_text='With async delivery, how long to wait for more alerts for the same channel before posting.'),
+        ),
+        migrations.CreateModel(
+            name='MatterMostPendingAlert',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('channel_id', models.CharField(max_length=64)),
+                ('status', models.CharField(max_length=50)),
+                ('message', models.TextField()),
+                ('users_to_add', models.TextField(help_text='JSON list of MM usernames to add to the channel.')),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('instance', models.ForeignKey(to='cabotapp.MatterMostInstance', on_delete=django.db.models.deletion.CASCADE)),
+                ('service', models.ForeignKey(to='cabotapp.Service', on_delete=django.db.models.deletion.CASCADE)),
+            ],
+        ),
+        migrations.AlterIndexTogether(
+            name='mattermostpendingalert',
+            index_together=set([('instance', 'channel_id')]),
+        ),
+    ]
@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cabotapp', '0001_initial'),
+        ('cabot_alert_mattermost', '0004_async_delivery'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='mattermostinstancesettings',
+            name='thread_incidents',
+            field=models.BooleanField(default=False, help_text="Post status changes as replies in a thread per incident (and update the thread's first post), instead of a new post for every status change. Not used for coalesced async deliveries."),
+        ),
+        migrations.CreateModel(
+            name='MatterMostIncidentPost',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('channel_id', models.CharField(max_length=64)),
+                ('post_id', models.CharField(max_length=64)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('service', models.ForeignKey(to='cabotapp.Service', on_delete=django.db.models.deletion.CASCADE)),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='mattermostincidentpost',
+            unique_together=set([('service', 'channel_id')]),
+        ),
+    ]
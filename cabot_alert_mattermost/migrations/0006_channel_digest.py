@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cabotapp', '0001_initial'),
+        ('cabot_alert_mattermost', '0005_incident_threads'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='mattermostpendingalert',
+            name='alert',
+            field=models.BooleanField(default=True, help_text='Whether users_to_add are @mentioned (in a digest).'),
+        ),
+        migrations.CreateModel(
+            name='MatterMostChannelDigest',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('channel_id', models.CharField(max_length=64, help_text="The channel (a service's Mattermost room ID, or the instance's default channel).")),
+                ('window_seconds', models.PositiveIntegerField(default=300, help_text='How long to buffer alerts for the channel before posting the digest.')),
+                ('instance', models.ForeignKey(to='cabotapp.MatterMostInstance', on_delete=django.db.models.deletion.CASCADE)),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='mattermostchanneldigest',
+            unique_together=set([('instance', 'channel_id')]),
+        ),
+    ]
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cabotapp', '0001_initial'),
+        ('cabot_alert_mattermost', '0006_channel_digest'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='mattermostinstancesettings',
+            name='lazy_images',
+            field=models.BooleanField(default=False, help_text='Instead of uploading status images with every alert, add "show graph" buttons and links to it, and only render and upload an image when someone asks for it.'),
+        ),
+    ]
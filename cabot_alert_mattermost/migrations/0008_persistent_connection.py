@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cabotapp', '0001_initial'),
+        ('cabot_alert_mattermost', '0007_lazy_images'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='mattermostinstancesettings',
+            name='persistent_connection',
+            field=models.BooleanField(default=False, help_text='Keep a connection to this instance open at all times, health checking it in the background and reconnecting when it fails, so alerts never wait for a new connection.'),
+        ),
+    ]
@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cabotapp', '0001_initial'),
+        ('cabot_alert_mattermost', '0008_persistent_connection'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MatterMostOutboxPost',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('channel_id', models.CharField(max_length=64)),
+                ('payload', models.TextField(help_text='JSON body of the post (message, attachments and file IDs).')),
+                ('attempts', models.PositiveIntegerField(default=0)),
+                ('next_attempt', models.DateTimeField(db_index=True)),
+                ('last_error', models.TextField(blank=True)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('instance', models.ForeignKey(to='cabotapp.MatterMostInstance', on_delete=django.db.models.deletion.CASCADE)),
+                ('service', models.ForeignKey(blank=True, to='cabotapp.Service', help_text='Not set for posts about several services (coalesced alerts, digests).', null=True, on_delete=django.db.models.deletion.CASCADE)),
+            ],
+        ),
+    ]
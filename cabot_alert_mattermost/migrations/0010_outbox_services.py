@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+def copy_outbox_services(apps, schema_editor):
+    MatterMostOutboxPost = apps.get_model('cabot_alert_mattermost', 'MatterMostOutboxPost')
+    for outbox_post in MatterMostOutboxPost.objects.exclude(service=None):
+        outbox_post.services.add(outbox_post.service_id)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cabotapp', '0001_initial'),
+        ('cabot_alert_mattermost', '0009_outbox'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='mattermostoutboxpost',
+            name='services',
+            field=models.ManyToManyField(help_text='The services the post is about (several for coalesced alerts and digests).', related_name='mattermost_outbox_posts', to='cabotapp.Service', blank=True),
+        ),
+        migrations.RunPython(copy_outbox_services, migrations.RunPython.noop),
+        migrations.RemoveField(
+            model_name='mattermostoutboxpost',
+            name='service',
+        ),
+    ]
@@ -1,18 +1,45 @@
-from django.core.exceptions import ValidationError
+from django.core.cache import DEFAULT_CACHE_ALIAS, cache, caches
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.exceptions import PermissionDenied, ValidationError
 from django.core.urlresolvers import reverse
-from django.db import models
+from django.db import connection, models, transaction
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
 from urlparse import urljoin
 from cabot.cabotapp.alert import AlertPlugin, AlertPluginUserData
+from cabot.cabotapp.models import Service, StatusCheckResult, UserProfile
+from django.utils import timezone
+from django.utils.crypto import salted_hmac
 
 from os import environ as env
 
 from django.conf import settings
-from django.template import Context, Template
+from django.contrib.auth.models import User
+from django.template import Context, Template, TemplateSyntaxError
 
+import hashlib
+import json
+import math
+import operator
 import requests
 import logging
+import threading
+import time
+import uuid
+from collections import OrderedDict, namedtuple
+from datetime import timedelta
+from io import BytesIO
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
 
 from cabot.cabotapp.utils import build_absolute_url
+from cabot_alert_mattermost import metrics, tasks
+from cabot_alert_mattermost.cache import TTLCache
+from cabot_alert_mattermost.client import KEEPALIVE_INTERVAL, RETRY_STATUS_CODES, CircuitBreaker, get_client, \
+    forget_client
 
 logger = logging.getLogger(__name__)
 
@@ -23,6 +50,27 @@ CABOT_USERNAME = env.get('MATTERMOST_CABOT_USERNAME', 'cabot')
 # this is useful for dummy users (PagerDuty, mailing list users, etc.)
 IGNORE_ALIAS = 'ignore'
 
+# status images larger than this (in bytes) are downscaled before uploading, or skipped if that isn't possible
+MAX_IMAGE_BYTES = int(env.get('MATTERMOST_MAX_IMAGE_BYTES', 2 * 1024 * 1024))
+
+# posts that failed because Mattermost was unavailable are kept in an outbox (MatterMostOutboxPost) and retried,
+# with exponential backoff, for up to OUTBOX_MAX_AGE seconds. At most OUTBOX_MAX_SIZE posts are kept (oldest dropped).
+OUTBOX_MAX_SIZE = int(env.get('MATTERMOST_OUTBOX_MAX_SIZE', 1000))
+OUTBOX_MAX_AGE = int(env.get('MATTERMOST_OUTBOX_MAX_AGE', 24 * 60 * 60))
+OUTBOX_RETRY_BACKOFF = int(env.get('MATTERMOST_OUTBOX_RETRY_BACKOFF', 30))
+OUTBOX_MAX_RETRY_DELAY = int(env.get('MATTERMOST_OUTBOX_MAX_RETRY_DELAY', 60 * 60))
+# how many posts a replay sends (the rest are left for the next one)
+OUTBOX_BATCH_SIZE = 100
+
+# queued alerts that are this many seconds past their delivery time are assumed to have lost their delivery task
+PENDING_ALERT_GRACE_SECONDS = 60
+
+# how long before a check's last_run its last result may have completed (see _get_failing_checks_bulk)
+LAST_RESULT_WINDOW = timedelta(minutes=5)
+
+# sentinel for cache lookups, since None is a valid cached value
+_NOT_CACHED = object()
+
 EMOJIS = {
     'WARNING': ":thinking:",
     'ERROR': ":sad-panda:",
@@ -60,13 +108,13 @@ MESSAGE_TEMPLATE_ALERT = '''
 **[Service]({{ service_url }}) is reporting {{ status }}** {{ emoji }}
 {% endwith %}
 ##### Failing checks
-{% for check in service.all_failing_checks %}
+{% for check, last_result in failing_checks %}
 {% if check.check_category == 'Jenkins check' %}
-* [{{ check.name }}]({{ jenkins_api }}job/{{ check.name }}/{{ check.last_result.job_number }}/console) {{ check.last_result.error | default:'' | safe }}
+* [{{ check.name }}]({{ jenkins_api }}job/{{ check.name }}/{{ last_result.job_number }}/console) {{ last_result.error | default:'' | safe }}
 {% else %}
 {% url 'check' pk=check.id as check_uri %}
 {% with scheme|add:'://'|add:host|add:check_uri as check_url %}
-* [{{ check.name }}]({{ check_url }}) - {{ check.last_result.error | default:'' | safe }}
+* [{{ check.name }}]({{ check_url }}) - {{ last_result.error | default:'' | safe }}
 {% endwith %}
 {% endif %}
 {% endfor %}
@@ -81,6 +129,25 @@ Someone tell {% for name, profile_link in missing_aliases %}[{{ name }}]({{ prof
 {% endspaceless %}
 '''
 
+# one post summarizing the alerts buffered for a channel in digest mode (see MatterMostChannelDigest)
+DIGEST_TEMPLATE = '''
+{% spaceless %}
+### {{ services|length }} service{{ services|length|pluralize }} changed status
+{% for service, status, emoji, failing_checks in services %}
+{% url 'service' pk=service.id as service_uri %}
+{% with scheme|add:'://'|add:host|add:service_uri as service_url %}
+* **[{{ service.name | safe }}]({{ service_url }})** is {{ status }} {{ emoji }}{% for check, last_result in failing_checks %}{% url 'check' pk=check.id as check_uri %}{% if forloop.first %} - {% else %}, {% endif %}[{{ check.name }}]({{ scheme }}://{{ host }}{{ check_uri }}){% endfor %}
+{% endwith %}
+{% endfor %}
+{% if users %}
+{% for alias in users %} @{{ alias }}{% endfor %} :point_up:
+{% endif %}
+{% endspaceless %}
+'''
+
+# most severe first, to pick the color of a digest
+STATUS_SEVERITY = ['CRITICAL', 'ERROR', 'WARNING', 'ACKED', 'PASSING']
+
 
 def _check_response(response):
     # type: (requests.Response) -> None
@@ -91,14 +158,24 @@ def _check_response(response):
         raise requests.HTTPError(e.message + ', response body: ' + response.text, response=response)
 
 
+def _get_mm_api_for_instance(instance):
+    """
+    :param instance: the MatterMostInstance
+    :return: a tuple of (api_endpoint_url, http_headers)
+    """
+    api_url = urljoin(instance.server_url, 'api/v4/')
+    headers = {
+        'Authorization': 'Bearer {}'.format(instance.api_token),
+    }
+    return api_url, headers
+
+
 def _get_mm_api_for_service(service):
     """
     :param service: the service to pull from (to get MM instance, etc...)
     :return: a tuple of (api_endpoint_url, http_headers, channel_id)
     """
     if service.mattermost_instance is not None:
-        server_url = service.mattermost_instance.server_url
-        api_token = service.mattermost_instance.api_token
         channel_id = service.mattermost_instance.default_channel_id
     else:
         raise RuntimeError('Mattermost instance not set.')
@@ -108,83 +185,766 @@ def _get_mm_api_for_service(service):
     if not channel_id:
         raise RuntimeError('Mattermost channel ID not set.')
 
-    api_url = urljoin(server_url, 'api/v4/')
-    headers = {
-        'Authorization': 'Bearer {}'.format(api_token),
-    }
+    api_url, headers = _get_mm_api_for_instance(service.mattermost_instance)
     return api_url, headers, channel_id
 
 
+def _get_mm_client(service):
+    """
+    :param service: the service to pull from (to get MM instance, etc...)
+    :return: the shared MatterMostClient for the service's MM instance, configured with the instance's settings
+    """
+    if service.mattermost_instance is None:
+        raise RuntimeError('Mattermost instance not set.')
+    return _get_mm_client_for_instance(service.mattermost_instance)
+
+
+def _get_mm_client_for_instance(instance):
+    """
+    :param instance: the MatterMostInstance
+    :return: the shared MatterMostClient for the instance, configured with the instance's settings
+    """
+    url, headers = _get_mm_api_for_instance(instance)
+    # the settings are only cached for a while, so a client whose settings were changed (possibly by another
+    # process) is replaced with one using the new settings
+    return get_client(url, headers, options=_get_client_options(instance))
+
+
+# MatterMostInstance id -> MatterMostInstanceSettings, so we don't query them on every alert
+# (expires so changes made by other processes are picked up eventually)
+_instance_settings = TTLCache(max_size=1000, ttl=60)
+
+
+def _get_instance_settings(instance):
+    """
+    :param instance: the MatterMostInstance
+    :return: the instance's MatterMostInstanceSettings, or an unsaved one with the defaults if it has none
+    """
+    instance_settings = _instance_settings.get(instance.id)
+    if instance_settings is None:
+        try:
+            instance_settings = MatterMostInstanceSettings.objects.get(instance=instance)
+        except MatterMostInstanceSettings.DoesNotExist:
+            instance_settings = MatterMostInstanceSettings(instance=instance)
+        _instance_settings.set(instance.id, instance_settings)
+    return instance_settings
+
+
+# (MatterMostInstance id, channel id) -> MatterMostChannelDigest, or None if the channel isn't in digest mode
+_channel_digests = TTLCache(max_size=1000, ttl=60)
+
+
+def _get_channel_digest(instance, channel_id):
+    """
+    :param instance: the MatterMostInstance
+    :param channel_id: MM channel ID
+    :return: the channel's MatterMostChannelDigest, or None if the channel isn't in digest mode
+    """
+    digest = _channel_digests.get((instance.id, channel_id), _NOT_CACHED)
+    if digest is _NOT_CACHED:
+        digest = MatterMostChannelDigest.objects.filter(instance=instance, channel_id=channel_id).first()
+        _channel_digests.set((instance.id, channel_id), digest)
+    return digest
+
+
+def _get_client_options(instance):
+    """
+    :param instance: the MatterMostInstance
+    :return: kwargs for MatterMostClient, from the instance's MatterMostInstanceSettings
+    """
+    instance_settings = _get_instance_settings(instance)
+    return {
+        'max_concurrency': instance_settings.max_concurrency,
+        'keepalive_interval': KEEPALIVE_INTERVAL if instance_settings.persistent_connection else None,
+    }
+
+
+def _delivery_countdown(instance, channel_id):
+    """
+    :param instance: the MatterMostInstance
+    :param channel_id: MM channel ID
+    :return: how long (seconds) alerts queued for the channel wait for more alerts before they're delivered
+    """
+    digest = _get_channel_digest(instance, channel_id)
+    if digest is not None:
+        return digest.window_seconds
+    return _get_instance_settings(instance).coalesce_seconds
+
+
+def _build_attachment(service_name, status, message):
+    """
+    :return: the message attachment for an alert, see https://docs.mattermost.com/developer/message-attachments.html
+    """
+    return {
+        'fallback': '{} is {}'.format(service_name, status),  # this shows in notifications
+        'color': COLORS.get(status),
+        'text': message,
+    }
+
+
+def _closing_db_connection(func):
+    """
+    Wrap a function run by MatterMostClient.map() so it doesn't leave the worker thread's DB connection open.
+    map() runs func in the calling thread when there's nothing to run in parallel, and that thread's connection
+    (possibly in the middle of a transaction) is left alone.
+    """
+    caller = threading.current_thread()
+
+    def wrapper(*args, **kwargs):
+        try:
+            return func(*args, **kwargs)
+        finally:
+            if threading.current_thread() is not caller:
+                connection.close()
+    return wrapper
+
+
+def _get_failing_checks(service):
+    """
+    Fetch a service's failing checks along with their last results, in a fixed number of queries for checks that ran
+    recently (rather than one check.last_result() query per check).
+    :param service: the Service we're alerting for
+    :return: list of (check, last_result) tuples; last_result is None if the check has never run
+    """
+    return _get_failing_checks_bulk([service])[service.id]
+
+
+def _get_failing_checks_bulk(services):
+    """
+    Like _get_failing_checks, for several services: the last results of all their failing checks are fetched
+    together.
+    :param services: list of Services
+    :return: dict of service id -> list of (check, last_result) tuples
+    """
+    checks = dict((service.id, list(service.all_failing_checks())) for service in services)
+    all_checks = dict((check.id, check) for service_checks in checks.values() for check in service_checks)
+    if not all_checks:
+        return dict((service_id, []) for service_id in checks)
+
+    # the last result is the latest one by time_complete (like check.last_result()). A check's last result completes
+    # around its last_run, so only results since then are looked at, rather than the check's whole result history
+    windows = [models.Q(status_check=check.id, time_complete__gte=check.last_run - LAST_RESULT_WINDOW)
+               for check in all_checks.values() if check.last_run is not None]
+    results = {}
+    if windows:
+        for result in StatusCheckResult.objects.filter(reduce(operator.or_, windows)) \
+                .order_by('time_complete').defer('raw_data'):
+            results[result.status_check_id] = result
+    for check in all_checks.values():
+        if check.id not in results:
+            # no result around the last run (or no last_run), so look it up the slow way
+            results[check.id] = check.last_result()
+    return dict((service_id, [(check, results.get(check.id)) for check in service_checks])
+                for service_id, service_checks in checks.items())
+
+
+def _file_cache_key(channel_id, data):
+    """:return: key for MatterMostClient.file_ids, identifying a file's content in a channel"""
+    return channel_id, hashlib.sha1(data).hexdigest()
+
+
+def _shrink_image(data, max_bytes):
+    """
+    Downscale an image so it's at most max_bytes large. Needs PIL (Pillow), which is optional.
+    :return: the downscaled image as PNG data, or None if it couldn't be shrunk enough
+    """
+    if Image is None:
+        return None
+    try:
+        image = Image.open(BytesIO(data))
+        # PNG size is roughly proportional to the number of pixels
+        scale = math.sqrt(float(max_bytes) / len(data)) * 0.9
+        image.thumbnail((max(1, int(image.size[0] * scale)), max(1, int(image.size[1] * scale))))
+        out = BytesIO()
+        image.save(out, format='PNG', optimize=True)
+    except (IOError, ValueError):
+        logger.exception('Failed to shrink image.')
+        return None
+    data = out.getvalue()
+    return data if len(data) <= max_bytes else None
+
+
+def _render_status_image(check):
+    """
+    :param check: a StatusCheck
+    :return: a ('filename', data) tuple for the check's status image, or None if it has no image
+    """
+    image = check.get_status_image()
+    if image is None:
+        return None
+    return '{}.png'.format(check.name), image
+
+
+# rendered status images are cached per check result, since rendering a graph is expensive
+STATUS_IMAGE_KEY = 'cabot_alert_mattermost.status_image.{}.{}'
+STATUS_IMAGE_CACHE_TIMEOUT = 60 * 60
+
+# how long (seconds) the 'show graph' buttons and links of an alert keep working
+STATUS_IMAGE_LINK_TTL = int(env.get('MATTERMOST_STATUS_IMAGE_LINK_TTL', 7 * 24 * 60 * 60))
+
+
+def _get_cached_status_image(check):
+    """
+    :param check: a StatusCheck
+    :return: like _render_status_image, but only rendered once per check result
+    """
+    result_id = StatusCheckResult.objects.filter(status_check=check).order_by('-id') \
+        .values_list('id', flat=True).first()
+    key = STATUS_IMAGE_KEY.format(check.id, result_id)
+    image = cache.get(key)
+    if image is None:
+        image = _render_status_image(check)
+        # remember checks without images too
+        cache.set(key, image or (), STATUS_IMAGE_CACHE_TIMEOUT)
+    return image or None
+
+
+def _sign(kind, *values):
+    """
+    :param kind: what the token is for ('link' or 'action'), so a token for one can't be used for the other
+    :return: a token proving the values came from us, for the status image endpoints
+    """
+    return salted_hmac('cabot_alert_mattermost.status_image.' + kind,
+                       ':'.join(unicode(v) for v in values)).hexdigest()
+
+
+def _status_image_links(instance, channel_id, checks):
+    """
+    For lazy status images: a 'show graph' button (a Mattermost interactive message action) and a link per check,
+    so graphs are only rendered when someone asks for them (see views.py). Both stop working after
+    STATUS_IMAGE_LINK_TTL, and the buttons only work in the alert's channel.
+    :param instance: the MatterMostInstance the alert is posted to
+    :param channel_id: channel ID the alert is posted in
+    :param checks: the failing checks (only the first 5 are used)
+    :return: tuple of (list of attachment actions, markdown links line)
+    """
+    expires = int(time.time()) + STATUS_IMAGE_LINK_TTL
+    actions = []
+    links = []
+    for check in checks[:5]:
+        actions.append({
+            'id': 'graph{}'.format(check.id),
+            'name': u'Show graph: {}'.format(check.name),
+            'integration': {
+                'url': build_absolute_url(reverse('mattermost-status-image-action')),
+                'context': {
+                    'instance_id': instance.id,
+                    'check_id': check.id,
+                    'channel_id': channel_id,
+                    'expires': expires,
+                    'token': _sign('action', instance.id, check.id, channel_id, expires),
+                },
+            },
+        })
+        links.append(u'[{}]({}?expires={}&token={})'.format(
+            check.name, build_absolute_url(reverse('mattermost-status-image', kwargs={'check_id': check.id})),
+            expires, _sign('link', check.id, expires)))
+    return actions, u'Graphs: ' + u', '.join(links) if links else u''
+
+
+# compiled templates, keyed by template source (a source always compiles to the same template, the size and TTL
+# only keep sources that are no longer used, e.g. after a template was edited, from piling up)
+_compiled_templates = TTLCache(max_size=1000, ttl=24 * 60 * 60)
+
+# (service id, instance id, template kind) -> compiled message template to use for that service
+# cleared whenever the generation stored under MESSAGE_TEMPLATE_GENERATION_KEY in the Django cache changes
+# (i.e. when a MatterMostMessageTemplate is saved/deleted, possibly by another process), and expires after
+# MESSAGE_TEMPLATE_LOCAL_TTL seconds in case the generation isn't shared (e.g. with the local memory cache backend)
+MESSAGE_TEMPLATE_LOCAL_TTL = 60
+_message_templates = TTLCache(max_size=10000, ttl=MESSAGE_TEMPLATE_LOCAL_TTL)
+_message_templates_generation = [None]
+_message_templates_lock = threading.Lock()
+MESSAGE_TEMPLATE_GENERATION_KEY = 'cabot_alert_mattermost.message_template_generation'
+
+
+def _compile_template(source):
+    # type: (unicode) -> Template
+    """Compile a template, or return the already compiled template for the same source."""
+    template = _compiled_templates.get(source)
+    if template is None:
+        template = Template(source)
+        _compiled_templates.set(source, template)
+    return template
+
+
+def _get_message_template(service, kind):
+    # type: (Service, str) -> Template
+    """
+    :param service: the Service we're alerting for
+    :param kind: MatterMostMessageTemplate.NORMAL or MatterMostMessageTemplate.ALERT
+    :return: the compiled template to render for the service: its own custom template if it has one,
+             otherwise its MM instance's custom template, otherwise the built in one
+    """
+    return _get_message_templates([service], kind)[service.id]
+
+
+def _get_message_templates(services, kind=None):
+    """
+    Like _get_message_template, for several services: custom templates that aren't cached yet are fetched together.
+    :param services: list of Services
+    :param kind: MatterMostMessageTemplate.NORMAL or MatterMostMessageTemplate.ALERT, or None for the kind matching
+                 each service's status
+    :return: dict of service id -> compiled template
+    """
+    generation = cache.get(MESSAGE_TEMPLATE_GENERATION_KEY)
+    keys = dict((service.id, (service.id, service.mattermost_instance_id, kind or _template_kind(service)))
+                for service in services)
+    with _message_templates_lock:
+        if generation != _message_templates_generation[0]:
+            _message_templates.clear()
+            _message_templates_generation[0] = generation
+        templates = {}
+        for service_id, key in keys.items():
+            template = _message_templates.get(key)
+            if template is not None:
+                templates[service_id] = template
+
+    uncached = [service for service in services if service.id not in templates]
+    if not uncached:
+        return templates
+
+    custom = {}
+    for t in MatterMostMessageTemplate.objects.filter(
+            models.Q(service__in=uncached) |
+            models.Q(service__isnull=True,
+                     instance_id__in=set(service.mattermost_instance_id for service in uncached) - {None}),
+            kind__in=set(keys[service.id][2] for service in uncached)):
+        custom[('service', t.service_id) if t.service_id is not None else ('instance', t.instance_id), t.kind] = \
+            t.template
+
+    loaded = {}
+    for service in uncached:
+        key = keys[service.id]
+        source = custom.get((('service', service.id), key[2])) or \
+            custom.get((('instance', service.mattermost_instance_id), key[2])) or \
+            (MESSAGE_TEMPLATE_NORMAL if key[2] == MatterMostMessageTemplate.NORMAL else MESSAGE_TEMPLATE_ALERT)
+        loaded[key] = templates[service.id] = _compile_template(source)
+    with _message_templates_lock:
+        if generation == _message_templates_generation[0]:
+            for key, template in loaded.items():
+                _message_templates.set(key, template)
+    return templates
+
+
+# user id -> (alias, None) for users with a MM alias, or (None, (name, profile link)) for users without one.
+# Entries live in the Django cache under USER_ALIAS_KEY (so all processes share them, and signals keep them up to
+# date), and are mirrored in _user_aliases for USER_ALIAS_LOCAL_TTL seconds. The mirror is also cleared whenever the
+# generation stored under USER_ALIAS_GENERATION_KEY changes (i.e. when an alias or user is changed, possibly by
+# another process)
+USER_ALIAS_LOCAL_TTL = 60
+_user_aliases = TTLCache(max_size=10000, ttl=USER_ALIAS_LOCAL_TTL)
+_user_aliases_generation = [None]
+_user_aliases_lock = threading.Lock()
+USER_ALIAS_GENERATION_KEY = 'cabot_alert_mattermost.user_alias_generation'
+USER_ALIAS_KEY = 'cabot_alert_mattermost.user_alias.{}'
+USER_ALIAS_CACHE_TIMEOUT = 24 * 60 * 60
+
+
+def _user_alias_cache_timeout():
+    """
+    :return: how long to keep entries in the Django cache. A per-process cache backend can't be kept up to date by
+             other processes' signals, so its entries are only trusted as long as _user_aliases' are.
+    """
+    if isinstance(caches[DEFAULT_CACHE_ALIAS], LocMemCache):
+        return USER_ALIAS_LOCAL_TTL
+    return USER_ALIAS_CACHE_TIMEOUT
+
+
+def _user_alias_entry(user, mm_data):
+    """
+    :param user: the User
+    :param mm_data: the user's MatterMostAlertUserData, or None if they have none
+    :return: the user's _user_aliases entry
+    """
+    if mm_data is not None and mm_data.mattermost_alias:
+        return mm_data.mattermost_alias, None
+
+    if user.first_name:
+        name = u'{} {}'.format(user.first_name, user.last_name)
+    elif user.email:
+        name = user.email
+    else:
+        name = user.username
+    profile_link = build_absolute_url(reverse('update-alert-user-data',
+                                              kwargs={'pk': user.pk, 'alerttype': 'MatterMost Plugin'}))
+    return None, (name, profile_link)
+
+
+def _resolve_aliases(users):
+    """
+    Look up the MM aliases of users, from _user_aliases if possible, then from the Django cache, and only then
+    from the DB (in one query).
+    :param users: list of Users
+    :return: tuple of (list of aliases to @mention, list of (name, profile link) for users without an alias)
+    """
+    return _aliases_from_entries(_resolve_alias_entries(users), users)
+
+
+def _resolve_alias_entries(users):
+    """
+    :param users: list of Users
+    :return: dict of user id -> the user's _user_aliases entry (see _resolve_aliases)
+    """
+    users = list(OrderedDict((user.id, user) for user in users).values())
+
+    generation = cache.get(USER_ALIAS_GENERATION_KEY)
+    with _user_aliases_lock:
+        if generation != _user_aliases_generation[0]:
+            _user_aliases.clear()
+            _user_aliases_generation[0] = generation
+    entries = {}
+    for user in users:
+        entry = _user_aliases.get(user.id)
+        if entry is not None:
+            entries[user.id] = entry
+
+    uncached = [user for user in users if user.id not in entries]
+    if uncached:
+        shared = cache.get_many([USER_ALIAS_KEY.format(user.id) for user in uncached])
+        found = dict((user.id, shared[USER_ALIAS_KEY.format(user.id)])
+                     for user in uncached if USER_ALIAS_KEY.format(user.id) in shared)
+
+        unknown = [user for user in uncached if user.id not in found]
+        if unknown:
+            user_data = dict((mm_data.user.user_id, mm_data) for mm_data in
+                             MatterMostAlertUserData.objects.filter(user__user__in=unknown).select_related('user'))
+            loaded = dict((user.id, _user_alias_entry(user, user_data.get(user.id))) for user in unknown)
+            for user_id, entry in loaded.items():
+                # add, not set: a signal may have stored a newer entry since we read the DB, don't overwrite it
+                cache.add(USER_ALIAS_KEY.format(user_id), entry, _user_alias_cache_timeout())
+            found.update(loaded)
+
+        entries.update(found)
+        with _user_aliases_lock:
+            if generation == _user_aliases_generation[0]:
+                for user_id, entry in found.items():
+                    _user_aliases.set(user_id, entry)
+    return entries
+
+
+def _aliases_from_entries(entries, users):
+    """
+    :param entries: dict of user id -> _user_aliases entry, for (at least) the users
+    :param users: list of Users
+    :return: tuple of (list of aliases to @mention, list of (name, profile link) for users without an alias)
+    """
+    aliases = []
+    missing_aliases = []
+    for user_id in OrderedDict((user.id, None) for user in users):
+        alias, missing = entries[user_id]
+        if alias is None:
+            missing_aliases.append(missing)
+        elif alias != IGNORE_ALIAS:
+            aliases.append(alias)
+    return aliases, missing_aliases
+
+
+def _user_alias_changed(user_id, entry=None):
+    """
+    Update a user's entry in the Django cache (or drop it, if entry is None because the user is gone), and make every
+    process drop its copy.
+    Changed users always get their new entry stored, rather than just having the old one dropped, so a concurrent
+    _resolve_alias_entries that read the DB before the change can't store the old entry again.
+    """
+    if entry is None:
+        cache.delete(USER_ALIAS_KEY.format(user_id))
+    else:
+        cache.set(USER_ALIAS_KEY.format(user_id), entry, _user_alias_cache_timeout())
+    cache.set(USER_ALIAS_GENERATION_KEY, uuid.uuid4().hex, None)
+
+
+def _should_alert(service):
+    """
+    :param service: the Service we're alerting for, with its new overall_status and its old_overall_status
+    :return: None if the status change shouldn't be posted at all, otherwise whether users should be @mentioned
+    """
+    current_status = service.overall_status
+    old_status = service.old_overall_status
+
+    alert = True
+    if current_status == service.WARNING_STATUS:
+        # Don't alert at all for WARNING
+        alert = False
+    if current_status == service.ERROR_STATUS:
+        if old_status == service.ERROR_STATUS:
+            # Don't alert repeatedly for ERROR
+            alert = False
+    if current_status == service.PASSING_STATUS:
+        if old_status == service.ACKED_STATUS:
+            # Don't message repeatedly for new successes after ACKED failures
+            return None
+        if old_status == service.WARNING_STATUS:
+            # Don't alert for recovery from WARNING status
+            alert = False
+    if current_status == service.ACKED_STATUS:
+        if old_status == service.ACKED_STATUS:
+            # Don't message repeatedly for ACKED status
+            return None
+        if old_status == service.PASSING_STATUS:
+            # Don't message for acked failures even it started passing
+            return None
+        # Don't @mention when transitioning into the ACKED status
+        alert = False
+    return alert
+
+
+def _template_kind(service):
+    """:return: the kind of MatterMostMessageTemplate to render for the service's status"""
+    if service.overall_status == service.PASSING_STATUS:
+        return MatterMostMessageTemplate.NORMAL
+    return MatterMostMessageTemplate.ALERT
+
+
+def _render_message(service, template, aliases, missing_aliases, alert, failing_checks):
+    """
+    :param service: the Service we're alerting for
+    :param template: the compiled message template (see _get_message_template)
+    :param aliases: MM aliases to @mention
+    :param missing_aliases: (name, profile link) of users without an alias
+    :param alert: whether to @mention users
+    :param failing_checks: list of (check, last_result) tuples
+    :return: the rendered alert message
+    """
+    return template.render(Context({
+        'service': service,
+        'failing_checks': failing_checks,
+        'users': aliases,
+        'missing_aliases': missing_aliases,
+        'host': settings.WWW_HTTP_HOST,
+        'scheme': settings.WWW_SCHEME,
+        'alert': alert,
+        'jenkins_api': urljoin(settings.JENKINS_API, '/'),
+        'status': service.overall_status,
+        'emoji': EMOJIS.get(service.overall_status),
+    }))
+
+
+def _outbox_delay(attempts):
+    """:return: how long to wait before retrying a post that has already failed `attempts` times"""
+    return min(OUTBOX_RETRY_BACKOFF * (2 ** attempts), OUTBOX_MAX_RETRY_DELAY)
+
+
+def _is_retryable(error):
+    # type: (requests.RequestException) -> bool
+    """:return: whether a failed post might succeed later (Mattermost was unavailable, not rejecting the post)"""
+    return error.response is None or error.response.status_code in RETRY_STATUS_CODES
+
+
+def _supersede_outbox_posts(channel_id, services):
+    """
+    Drop the posts for a channel waiting in the outbox that are only about (some of) the given services, since a
+    newer post about them makes those stale. Posts that are also about other services are kept, so no service's
+    status change gets lost (they're replayed in order, so the newer post still comes out last).
+    :param channel_id: channel ID the newer post is for
+    :param services: the Services the newer post is about
+    :return: None
+    """
+    service_ids = [service.id for service in services]
+    if not service_ids:
+        return
+    through = MatterMostOutboxPost.services.through
+    candidates = set(through.objects.filter(mattermostoutboxpost__channel_id=channel_id, service_id__in=service_ids)
+                     .values_list('mattermostoutboxpost_id', flat=True))
+    if not candidates:
+        return
+    others = set(through.objects.filter(mattermostoutboxpost_id__in=candidates).exclude(service_id__in=service_ids)
+                 .values_list('mattermostoutboxpost_id', flat=True))
+    MatterMostOutboxPost.objects.filter(id__in=candidates - others).delete()
+
+
+def _save_to_outbox(instance, services, post, error):
+    """
+    Save a post that failed because Mattermost was unavailable, to be retried by tasks.replay_outbox (which also
+    runs periodically, so the outbox is drained even if this replay is lost). Replaces older posts for the channel
+    that are only about the same services, since only the latest status matters (see _supersede_outbox_posts).
+    :param instance: the MatterMostInstance the post is for
+    :param services: the Services the post is about (several for coalesced alerts and digests)
+    :param post: the JSON body of the post
+    :param error: why the post failed
+    :return: None
+    """
+    now = timezone.now()
+    with transaction.atomic():
+        _supersede_outbox_posts(post['channel_id'], services)
+        outbox_post = MatterMostOutboxPost.objects.create(instance=instance, channel_id=post['channel_id'],
+                                                          payload=json.dumps(post),
+                                                          next_attempt=now + timedelta(seconds=_outbox_delay(0)),
+                                                          last_error=unicode(error)[:1000])
+        outbox_post.services.add(*services)
+
+        overflow = list(MatterMostOutboxPost.objects.order_by('-id').values_list('id', flat=True)[OUTBOX_MAX_SIZE:])
+        if overflow:
+            logger.warn('Mattermost outbox is full, dropping the %s oldest posts.', len(overflow))
+            MatterMostOutboxPost.objects.filter(id__in=overflow).delete()
+            metrics.incr('outbox.dropped', len(overflow))
+    metrics.incr('outbox.saved')
+    logger.warn('Could not post to channel %s, saved the post to the outbox to retry it later.', post['channel_id'])
+    tasks.replay_outbox.apply_async(countdown=_outbox_delay(0))
+
+
+# an alert rendered by MatterMostAlert.render_alerts, ready to be sent
+RenderedAlert = namedtuple('RenderedAlert', ['service', 'message', 'aliases', 'alert', 'failing_checks'])
+
+# result of MatterMostAlert._add_users_to_channel: lists of usernames that are now in the channel or that don't exist
+# on MM, and a {username: HTTP status code} dict of users that couldn't be added
+ChannelMembershipResult = namedtuple('ChannelMembershipResult', ['added', 'failed', 'not_found'])
+
+
 class MatterMostAlert(AlertPlugin):
     name = "MatterMost"
     author = "Mahendra M"
 
-    def _add_users_to_channel(self, url, headers, channel_id, users_to_add):
+    def _add_users_to_channel(self, url, headers, channel_id, users_to_add, client=None):
         """
         Adds the given list of usernames to the given channel_id.
         Silently continues if some usernames can't be found on MM. Logs a warning if a user is found, but can't be added
         to the channel (e.g. if our bot doesn't have permissions for this channel).
+        User ids and memberships we've already confirmed are cached per MM instance, so in the steady state this
+        makes no API calls at all. Servers that support it get all users added in a single call.
         :param url: MM api v4 endpoint
         :param headers: HTTP headers (w/ api token)
         :param channel_id: channel ID to add users to
         :param users_to_add: list of usernames to add to the channel
-        :return: None
+        :param client: the instance's MatterMostClient (see _get_mm_client_for_instance)
+        :return: a ChannelMembershipResult (with lowercased usernames)
         """
+        result = ChannelMembershipResult(added=[], failed={}, not_found=[])
         if len(users_to_add) == 0:
-            return
+            return result
+
+        client = client or get_client(url, headers)
 
         # first, map usernames -> user ids, since the channels API requires ids
-        # note that any usernames that can't be found are just not included in the response
-        # for example, ["i_dont_exist", "i_exist", ""] returns [{"username": "i_exist", "id": "123123", ...}]
-        response = requests.post(urljoin(url, 'users/usernames'), headers=headers, json=users_to_add)
-        _check_response(response)
+        user_ids = {}
+        unknown_usernames = []
+        for username in sorted(set(u.lower() for u in users_to_add)):
+            user_id = client.user_ids.get(username, _NOT_CACHED)
+            if user_id is _NOT_CACHED:
+                unknown_usernames.append(username)
+            elif user_id is not None:
+                user_ids[username] = user_id
+            else:
+                result.not_found.append(username)
 
-        for user in response.json():
-            # can't find any bulk API for adding users to channel, so we do it one at a time
-            username = user['username']
-            user_id = user['id']
+        if unknown_usernames:
+            # note that any usernames that can't be found are just not included in the response
+            # for example, ["i_dont_exist", "i_exist", ""] returns [{"username": "i_exist", "id": "123123", ...}]
+            response = client.post('users/usernames', json=unknown_usernames)
+            _check_response(response)
+
+            found = dict((user['username'].lower(), user['id']) for user in response.json())
+            for username in unknown_usernames:
+                # remember usernames that don't exist too, so we don't look them up on every alert
+                client.user_ids.set(username, found.get(username))
+                if username not in found:
+                    result.not_found.append(username)
+            user_ids.update(found)
+
+        to_add = []
+        for username, user_id in sorted(user_ids.items()):
+            if client.channel_members.get((channel_id, user_id)):
+                result.added.append(username)
+            else:
+                to_add.append((username, user_id))
 
+        def record(username, user_id, status_code, text):
+            if status_code == 201:
+                client.channel_members.set((channel_id, user_id), True)
+                result.added.append(username)
+                return
+
+            if status_code in (403, 404):
+                # the user may have been deleted/renamed, look them up again next time
+                client.user_ids.delete(username)
+            result.failed[username] = status_code
+            logger.warn("Could not add user %s, id %s to channel id %s. "
+                        "Does the Cabot user have admin permissions in this channel?\n[%s] %s",
+                        username, user_id, channel_id, status_code, text)
+
+        if len(to_add) > 1 and client.supports_bulk_channel_members():
+            response = client.post('channels/{}/members'.format(channel_id),
+                                   json={'user_ids': [user_id for _, user_id in to_add]})
+            if response.status_code == 201:
+                added_ids = set(member['user_id'] for member in response.json())
+                for username, user_id in to_add:
+                    if user_id in added_ids:
+                        record(username, user_id, 201, '')
+                    else:
+                        record(username, user_id, None, 'missing from the bulk add response')
+                return result
+            if response.status_code not in (400, 501):
+                for username, user_id in to_add:
+                    record(username, user_id, response.status_code, response.text)
+                return result
+            # fall back to adding users one at a time. 501 means the server doesn't support bulk adds at all, a 400
+            # may be a server that doesn't understand user_ids, or a problem with one of the users, so try again later
+            logger.warn('Bulk channel add rejected by %s, falling back to one call per user.\n[%s] %s',
+                        url, response.status_code, response.text)
+            if response.status_code == 501:
+                client.bulk_channel_members = False
+            else:
+                client.pause_bulk_channel_members()
+
+        def add_to_channel(item):
+            username, user_id = item
             # if the user is already in the channel, this API call seems to just do nothing
-            response = requests.post(urljoin(url, 'channels/{}/members'.format(channel_id)),
-                                     headers=headers, json={'user_id': user_id})
-            if response.status_code != 201:
-                logger.warn("Could not add user %s, id %s to channel id %s. "
-                            "Does the Cabot user have admin permissions in this channel?\n[%s] %s",
-                            username, user_id, channel_id, response.status_code, response.text)
+            response = client.post('channels/{}/members'.format(channel_id), json={'user_id': user_id})
+            record(username, user_id, response.status_code, response.text)
+
+        # older servers have no bulk API for adding users to a channel, so we do it one at a time
+        # (in parallel, if the MM instance is configured for it)
+        client.map(add_to_channel, to_add)
+        return result
 
-    def _upload_files(self, url, headers, channel_id, files, timeout_seconds=30):
+    def _upload_files(self, url, headers, channel_id, files, timeout_seconds=30, client=None):
         """
         Upload a list of files to MM.
+        Each file is sent as the raw body of its own request (so no multipart body is built in memory, and one slow
+        file doesn't time out the others), in parallel if the MM instance is configured for it. Files larger than
+        MAX_IMAGE_BYTES are shrunk if possible, or skipped.
+        Uploaded file IDs are remembered until they're posted, so _get_file_ids can reuse them if the post fails.
         :param url: MM api v4 endpoint
         :param headers: HTTP headers (w/ api token)
         :param channel_id: channel ID to add users to
         :param files: list of files as ('filename', data) tuples
-        :param timeout_seconds: timeout for uploading all files (default 30s)
-        :return: list of MM file IDs
+        :param timeout_seconds: read timeout for uploading each file (default 30s)
+        :param client: the instance's MatterMostClient (see _get_mm_client_for_instance)
+        :return: list of MM file IDs, for the files that were uploaded successfully
         """
         if len(files) == 0:
             return []
 
-        # convert to a list of ('files', ('filename', <data>))
-        # (can't use dict form because we have multiple values for the 'files' key...)
-        files = [('files', (f[0], f[1])) for f in files]
+        client = client or get_client(url, headers)
 
-        response = requests.post(
-            urljoin(url, 'files'),
-            data={'channel_id': channel_id},
-            files=files,
-            headers=headers,
-            timeout=timeout_seconds,
-        )
-        _check_response(response)
+        def upload(f):
+            filename, data = f
+            if len(data) > MAX_IMAGE_BYTES:
+                data = _shrink_image(data, MAX_IMAGE_BYTES)
+                if data is None:
+                    logger.warn('Not uploading %s, it is larger than %s bytes.', filename, MAX_IMAGE_BYTES)
+                    return None
 
-        file_ids = [x['id'] for x in response.json()['file_infos']]
+            try:
+                response = client.post('files', params={'channel_id': channel_id, 'filename': filename}, data=data,
+                                       timeout=(client.timeout[0], timeout_seconds))
+                _check_response(response)
+            except requests.RequestException:
+                logger.exception('Failed to upload %s to channel %s.', filename, channel_id)
+                return None
+
+            metrics.incr('upload.files')
+            metrics.incr('upload.bytes', len(data))
+            file_id = response.json()['file_infos'][0]['id']
+            client.file_ids.set(_file_cache_key(channel_id, f[1]), file_id)
+            return file_id
+
+        file_ids = [file_id for file_id in client.map(upload, files) if file_id is not None]
         if not len(file_ids) == len(files):
-            logger.warn('It seems some files failed to upload (server returned %s file IDs, but we sent %s): %s',
-                        len(file_ids), len(files), response.json())
+            logger.warn('It seems some files failed to upload (got %s file IDs, but we sent %s)',
+                        len(file_ids), len(files))
         return file_ids
 
-    def _send_alert(self, service, message, users_to_add=[]):
+    def _send_alert(self, service, message, users_to_add=[], failing_checks=None):
         """
         Send an alert with the service status, failing checks for a service and images to a Mattermost channel
         :param service: the Service we're alerting for
@@ -192,123 +952,560 @@ class MatterMostAlert(AlertPlugin):
         :param users_to_add: MM usernames to ensure are in the channel (so @mentions work)
                              note that CABOT_USERNAME is automatically added to this list
                              (i.e. Cabot will add itself to any channels it sends messages to)
+        :param failing_checks: the service's failing checks, if the caller already fetched them
         :return: None
         """
         url, headers, channel_id = _get_mm_api_for_service(service)
+        client = _get_mm_client(service)
 
-        # ensure users we're going to @mention are in the channel (including the Cabot user)
-        # if the Cabot user isn't in the channel, we won't be able to send the message
-        try:
-            self._add_users_to_channel(url, headers, channel_id, users_to_add + [CABOT_USERNAME])
-        except requests.HTTPError:
-            logger.exception('Failed to add users to channel %s. Is the Cabot MM user an admin here?', channel_id)
+        if failing_checks is None:
+            failing_checks = list(service.all_failing_checks())
 
-        failing_checks = list(service.all_failing_checks())
+        attachment = _build_attachment(service.name, service.overall_status, message)
+        if _get_instance_settings(service.mattermost_instance).lazy_images and failing_checks:
+            # don't render any images now, just offer them
+            attachment['actions'], links = _status_image_links(service.mattermost_instance, channel_id,
+                                                               failing_checks)
+            attachment['text'] += u'\n' + links
+            failing_checks = []
+        if _get_instance_settings(service.mattermost_instance).thread_incidents:
+            self._post_threaded_alert(url, headers, channel_id, service, attachment, users_to_add, failing_checks,
+                                      client=client)
+        else:
+            self._post_attachments(url, headers, channel_id, [attachment], users_to_add, failing_checks,
+                                   outbox=(service.mattermost_instance, [service]), client=client)
 
-        # Upload images for all failing checks
+    def _post_attachments(self, url, headers, channel_id, attachments, users_to_add, failing_checks, root_id=None,
+                          render_image=None, outbox=None, client=None):
+        """
+        Post message attachments to a Mattermost channel, along with status images for the failing checks
+        :param url: MM api v4 endpoint
+        :param headers: HTTP headers (w/ api token)
+        :param channel_id: channel ID to post in
+        :param attachments: list of message attachments (see _build_attachment)
+        :param users_to_add: MM usernames to ensure are in the channel (CABOT_USERNAME is added automatically)
+        :param failing_checks: checks to include status images for (only the first 5 are used)
+        :param root_id: if set, post as a reply in the thread of this post
+        :param render_image: function to get a check's status image with (default: _render_status_image)
+        :param outbox: (MatterMostInstance, list of the Services the post is about) to save the post to the outbox
+                       under if Mattermost is unavailable, or None to just fail
+        :param client: the instance's MatterMostClient (see _get_mm_client_for_instance)
+        :return: the new post's id
+        """
+        client = client or get_client(url, headers)
+        render_image = render_image or _render_status_image
+
+        files = []
         file_ids = []
-        try:
-            files = []
-            for check in failing_checks[:5]:
-                image = check.get_status_image()
-                if image is not None:
-                    filename = '{}.png'.format(check.name)
-                    files.append((filename, image))
-            file_ids = self._upload_files(url, headers, channel_id, files)
-        except requests.HTTPError:
-            # continue anyway, just don't put any images in the message
-            logger.exception('Failed to get/upload images to channel %s.', channel_id)
+        reused_files = {}
+        if client.breaker.state != CircuitBreaker.CLOSED:
+            # MM is having trouble, don't make it worse: skip membership and images, and just try to post the text
+            logger.warn('Circuit breaker for %s is %s, only posting the alert text to channel %s.',
+                        url, client.breaker.state, channel_id)
+        else:
+            # ensure users we're going to @mention are in the channel (including the Cabot user)
+            # if the Cabot user isn't in the channel, we won't be able to send the message
+            try:
+                with metrics.stage('add_users'):
+                    self._add_users_to_channel(url, headers, channel_id, users_to_add + [CABOT_USERNAME],
+                                               client=client)
+            except requests.RequestException:
+                logger.exception('Failed to add users to channel %s. Is the Cabot MM user an admin here?',
+                                 channel_id)
+
+            # Upload images for all failing checks
+            try:
+                with metrics.stage('render_images'):
+                    if client.max_concurrency > 1:
+                        # render in parallel (in worker threads, which must not keep their own DB connections open)
+                        images = client.map(_closing_db_connection(render_image), failing_checks[:5])
+                    else:
+                        images = [render_image(check) for check in failing_checks[:5]]
+                files = [f for f in images if f is not None]
+                with metrics.stage('upload'):
+                    file_ids, reused_files = self._get_file_ids(url, headers, channel_id, files, client=client)
+            except requests.RequestException:
+                # continue anyway, just don't put any images in the message
+                logger.exception('Failed to get/upload images to channel %s.', channel_id)
 
         # post in the channel
-        response = requests.post(urljoin(url, 'posts'), headers=headers, json={
+        post = {
             'channel_id': channel_id,
             'message': '',
             'file_ids': file_ids,
             'props': {
-                'attachments': [{
-                    'fallback': '{} is {}'.format(service.name, service.overall_status),  # this shows in notifications
-                    'color': COLORS.get(service.overall_status),
-                    'text': message,
-                }]
+                'attachments': attachments,
             },
-        })
-        _check_response(response)
+        }
+        if root_id:
+            post['root_id'] = root_id
+        try:
+            with metrics.stage('post'):
+                response = client.post('posts', essential=True, idempotent=False, json=post)
+            if response.status_code in (403, 404):
+                # we've lost access to the channel (or it's gone), so don't trust the memberships we've cached for it
+                client.forget_channel(channel_id)
+            _check_response(response)
+        except requests.RequestException as e:
+            if outbox is not None and _is_retryable(e):
+                _save_to_outbox(outbox[0], outbox[1], post, e)
+            raise
+        post_id = response.json().get('id')
+        if outbox is not None:
+            # this post supersedes older posts about the same services that are still waiting in the outbox
+            _supersede_outbox_posts(channel_id, outbox[1])
 
-    def send_alert(self, service, users, duty_officers):
-        alert = True
-        users = list(users) + list(duty_officers)
-
-        # some users might not have MatterMostAlertUserData objects created yet,
-        # so we remove users from missing_users as we find them
-        missing_users = set(users)
-        aliases = []
-        for mm_data in MatterMostAlertUserData.objects.filter(user__user__in=users):
-            if mm_data.mattermost_alias:
-                if mm_data.mattermost_alias != IGNORE_ALIAS:
-                    aliases.append(mm_data.mattermost_alias)
-                missing_users.remove(mm_data.user.user)
-
-        missing_aliases = []
-        for user in missing_users:
-            if user.first_name:
-                name = u'{} {}'.format(user.first_name, user.last_name)
-            elif user.email:
-                name = user.email
+        if reused_files:
+            self._replace_rejected_files(url, headers, channel_id, post_id, response.json().get('file_ids') or [],
+                                         reused_files, client=client)
+        # MM attaches a file to a single post, so the files can't be reused anymore
+        for _, data in files:
+            client.file_ids.delete(_file_cache_key(channel_id, data))
+        return post_id
+
+    def _get_file_ids(self, url, headers, channel_id, files, client=None):
+        """
+        Get MM file IDs for a list of files. Files that were already uploaded to this channel for a post that then
+        failed (e.g. while Mattermost was having trouble), and so were never attached to a post, aren't uploaded
+        again; identical images are recognized by a hash of their content.
+        :param url: MM api v4 endpoint
+        :param headers: HTTP headers (w/ api token)
+        :param channel_id: channel ID the files will be posted in
+        :param files: list of files as ('filename', data) tuples
+        :param client: the instance's MatterMostClient (see _get_mm_client_for_instance)
+        :return: tuple of (list of MM file IDs, {reused file ID: ('filename', data)})
+        """
+        client = client or get_client(url, headers)
+        cached_ids = [client.file_ids.get(_file_cache_key(channel_id, data)) for _, data in files]
+
+        to_upload = [f for f, file_id in zip(files, cached_ids) if file_id is None]
+        # _upload_files remembers the IDs of the files it uploads
+        uploaded_ids = self._upload_files(url, headers, channel_id, to_upload, client=client) if to_upload else []
+
+        reused_files = dict((file_id, f) for f, file_id in zip(files, cached_ids) if file_id is not None)
+        return [file_id for file_id in cached_ids if file_id is not None] + uploaded_ids, reused_files
+
+    def _replace_rejected_files(self, url, headers, channel_id, post_id, posted_file_ids, reused_files, client=None):
+        """
+        MM won't attach a file ID to a post if it doesn't know it anymore (or if it's attached to another post), so
+        re-upload any cached files that didn't make it into the post, and add them to it.
+        :param url: MM api v4 endpoint
+        :param headers: HTTP headers (w/ api token)
+        :param channel_id: channel ID the post is in
+        :param post_id: the post
+        :param posted_file_ids: the file IDs MM says are attached to the post
+        :param reused_files: {reused file ID: ('filename', data)}, as returned by _get_file_ids
+        :param client: the instance's MatterMostClient (see _get_mm_client_for_instance)
+        :return: None
+        """
+        rejected = [file_id for file_id in reused_files if file_id not in posted_file_ids]
+        if not rejected:
+            return
+
+        client = client or get_client(url, headers)
+        for file_id in rejected:
+            client.file_ids.delete(_file_cache_key(channel_id, reused_files[file_id][1]))
+        try:
+            file_ids, _ = self._get_file_ids(url, headers, channel_id, [reused_files[f] for f in rejected],
+                                             client=client)
+            response = client.put('posts/{}/patch'.format(post_id), json={'file_ids': posted_file_ids + file_ids})
+        except requests.RequestException:
+            logger.exception('Failed to re-upload images to channel %s.', channel_id)
+            return
+
+        if response.status_code != 200:
+            logger.warn('Could not attach re-uploaded images to post %s.\n[%s] %s',
+                        post_id, response.status_code, response.text)
+
+    def _post_threaded_alert(self, url, headers, channel_id, service, attachment, users_to_add, failing_checks,
+                             client=None):
+        """
+        Post an alert as a reply in the thread of the service's ongoing incident, and update the thread's root post
+        to show the latest status. Starts a new thread if there is no ongoing incident.
+        :param url: MM api v4 endpoint
+        :param headers: HTTP headers (w/ api token)
+        :param channel_id: channel ID to post in
+        :param service: the Service we're alerting for
+        :param attachment: the alert's message attachment
+        :param users_to_add: MM usernames to ensure are in the channel
+        :param failing_checks: checks to include status images for
+        :param client: the instance's MatterMostClient (see _get_mm_client_for_instance)
+        :return: None
+        """
+        incident = MatterMostIncidentPost.objects.filter(service=service, channel_id=channel_id).first()
+        if incident is not None and service.old_overall_status == service.PASSING_STATUS:
+            # the last incident ended without us posting about it (e.g. it recovered while acked), this is a new one
+            incident.delete()
+            incident = None
+
+        if incident is not None:
+            try:
+                self._post_attachments(url, headers, channel_id, [attachment], users_to_add, failing_checks,
+                                       root_id=incident.post_id, outbox=(service.mattermost_instance, [service]),
+                                       client=client)
+            except requests.HTTPError as e:
+                if e.response is None or e.response.status_code not in (400, 404):
+                    raise
+                # the root post was probably deleted, so start a new thread
+                logger.warn('Could not reply to post %s for service %s, starting a new thread.',
+                            incident.post_id, service.name)
+                incident.delete()
+                incident = None
             else:
-                name = user.username
+                self._update_post(url, headers, incident.post_id, [attachment], client=client)
 
-            profile_link = build_absolute_url(reverse('update-alert-user-data',
-                                              kwargs={'pk': user.pk, 'alerttype': 'MatterMost Plugin'}))
-            missing_aliases.append((name, profile_link))
+        if incident is None:
+            post_id = self._post_attachments(url, headers, channel_id, [attachment], users_to_add, failing_checks,
+                                             outbox=(service.mattermost_instance, [service]), client=client)
+            if service.overall_status != service.PASSING_STATUS:
+                MatterMostIncidentPost.objects.create(service=service, channel_id=channel_id, post_id=post_id)
+        elif service.overall_status == service.PASSING_STATUS:
+            # the incident is over, the next failure starts a new thread
+            incident.delete()
 
-        current_status = service.overall_status
-        old_status = service.old_overall_status
+    def post_status_image(self, instance, channel_id, post_id, check):
+        """
+        Post a check's status image as a reply to an alert, when someone asks for it (see lazy_images).
+        :param instance: the MatterMostInstance
+        :param channel_id: channel ID the alert is in
+        :param post_id: the alert's post (or a reply in its thread)
+        :param check: the StatusCheck to post the image of
+        :return: the reply's post id
+        :raises PermissionDenied: if the post isn't in the channel
+        """
+        url, headers = _get_mm_api_for_instance(instance)
+        client = _get_mm_client_for_instance(instance)
+        with metrics.alert_timer(u'status image for {}'.format(check.name)) as timer:
+            response = client.get('posts/{}'.format(post_id))
+            _check_response(response)
+            if response.json().get('channel_id') != channel_id:
+                raise PermissionDenied(u'Post {} is not in channel {}.'.format(post_id, channel_id))
+            # replies have to go to the root of the thread
+            root_id = response.json().get('root_id') or post_id
+            reply_id = self._post_attachments(url, headers, channel_id, [], [], [check], root_id=root_id,
+                                              render_image=_get_cached_status_image, client=client)
+            timer.outcome = 'sent'
+        return reply_id
 
-        template = MESSAGE_TEMPLATE_NORMAL \
-            if current_status == service.PASSING_STATUS \
-            else MESSAGE_TEMPLATE_ALERT
+    def _update_post(self, url, headers, post_id, attachments, client=None):
+        """
+        Replace the attachments of an existing post. Logs (but doesn't raise) failures.
+        :param url: MM api v4 endpoint
+        :param headers: HTTP headers (w/ api token)
+        :param post_id: the post to update
+        :param attachments: the post's new message attachments
+        :param client: the instance's MatterMostClient (see _get_mm_client_for_instance)
+        :return: None
+        """
+        client = client or get_client(url, headers)
+        try:
+            response = client.put('posts/{}/patch'.format(post_id), json={'props': {'attachments': attachments}})
+        except requests.RequestException:
+            logger.exception('Could not update post %s.', post_id)
+            return
+        if response.status_code != 200:
+            logger.warn('Could not update post %s.\n[%s] %s', post_id, response.status_code, response.text)
 
-        emoji = EMOJIS.get(current_status)
+    def _queue_alert(self, service, message, users_to_add=[], alert=True):
+        """
+        Queue an alert to be delivered by a celery task, instead of posting it right away.
+        Alerts queued for the same channel within the instance's coalesce_seconds (or the channel's digest window)
+        are sent as a single post.
+        :param service: the Service we're alerting for
+        :param message: the message to post
+        :param users_to_add: MM usernames to ensure are in the channel (so @mentions work)
+        :param alert: whether users_to_add should be @mentioned in a digest
+        :return: None
+        """
+        _, _, channel_id = _get_mm_api_for_service(service)
+        instance = service.mattermost_instance
 
-        if current_status == service.WARNING_STATUS:
-            # Don't alert at all for WARNING
-            alert = False
-        if current_status == service.ERROR_STATUS:
-            if old_status == service.ERROR_STATUS:
-                # Don't alert repeatedly for ERROR
-                alert = False
-        if current_status == service.PASSING_STATUS:
-            if old_status == service.ACKED_STATUS:
-                # Don't message repeatedly for new successes after ACKED failures
-                return
-            if old_status == service.WARNING_STATUS:
-                # Don't alert for recovery from WARNING status
-                alert = False
-        if current_status == service.ACKED_STATUS:
-            if old_status == service.ACKED_STATUS:
-                # Don't message repeatedly for ACKED status
-                return
-            if old_status == service.PASSING_STATUS:
-                # Don't message for acked failures even it started passing
+        pending = MatterMostPendingAlert.objects.create(instance=instance, channel_id=channel_id, service=service,
+                                                        status=service.overall_status, message=message,
+                                                        users_to_add=json.dumps(users_to_add), alert=alert)
+        # the first alert queued for a channel schedules the delivery, later ones get picked up by it. This is checked
+        # after queuing, so an alert queued while a delivery is running is either picked up by that delivery, or
+        # seen by its check for leftovers, or is the oldest one left and schedules the next delivery itself
+        oldest = MatterMostPendingAlert.objects.filter(instance=instance, channel_id=channel_id) \
+            .order_by('id').values_list('id', 'created').first()
+        if oldest is None:
+            return
+        countdown = _delivery_countdown(instance, channel_id)
+        if oldest[0] == pending.id:
+            tasks.deliver_pending_alerts.apply_async(args=[instance.id, channel_id], countdown=countdown)
+        elif oldest[1] < timezone.now() - timedelta(seconds=countdown + PENDING_ALERT_GRACE_SECONDS):
+            # the oldest alert should have been delivered long ago, so its delivery was lost: deliver right away
+            logger.warn('Alerts for channel %s are overdue, scheduling another delivery.', channel_id)
+            tasks.deliver_pending_alerts.apply_async(args=[instance.id, channel_id], countdown=0)
+
+    def deliver_pending_alerts(self, instance, channel_id):
+        """
+        Post all alerts queued for a channel (see _queue_alert) as a single post, with one attachment per service
+        (or as a digest, if the channel is in digest mode).
+        If a service was queued several times, only its latest alert is sent.
+        :param instance: the MatterMostInstance
+        :param channel_id: channel ID to post in
+        :return: None
+        """
+        with transaction.atomic():
+            pending = list(MatterMostPendingAlert.objects.select_for_update()
+                           .filter(instance=instance, channel_id=channel_id)
+                           .select_related('service').order_by('id'))
+            MatterMostPendingAlert.objects.filter(id__in=[p.id for p in pending]).delete()
+        # alerts queued while we were selecting these may have seen them, and left the delivery to us
+        if MatterMostPendingAlert.objects.filter(instance=instance, channel_id=channel_id).exists():
+            tasks.deliver_pending_alerts.apply_async(args=[instance.id, channel_id],
+                                                     countdown=_delivery_countdown(instance, channel_id))
+        if not pending:
+            return
+
+        latest = OrderedDict()
+        for p in pending:
+            latest.pop(p.service_id, None)
+            latest[p.service_id] = p
+
+        if _get_channel_digest(instance, channel_id) is not None:
+            self._post_digest(instance, channel_id, latest.values())
+            return
+
+        lazy_images = _get_instance_settings(instance).lazy_images
+        service_checks = _get_failing_checks_bulk([p.service for p in latest.values()])
+        attachments = []
+        users_to_add = set()
+        failing_checks = []
+        for p in latest.values():
+            attachment = _build_attachment(p.service.name, p.status, p.message)
+            checks = [check for check, _ in service_checks[p.service_id]]
+            if lazy_images and checks:
+                attachment['actions'], links = _status_image_links(instance, channel_id, checks)
+                attachment['text'] += u'\n' + links
+            else:
+                failing_checks.extend(checks)
+            attachments.append(attachment)
+            users_to_add.update(json.loads(p.users_to_add))
+
+        url, headers = _get_mm_api_for_instance(instance)
+        client = _get_mm_client_for_instance(instance)
+        with metrics.alert_timer('{} services in channel {}'.format(len(latest), channel_id)) as timer:
+            self._post_attachments(url, headers, channel_id, attachments, sorted(users_to_add), failing_checks,
+                                   outbox=(instance, [p.service for p in latest.values()]), client=client)
+            timer.outcome = 'sent'
+
+    def replay_outbox(self):
+        """
+        Retry the posts in the outbox (see _save_to_outbox) that are due. Posts that fail again are retried later
+        with exponential backoff, until they're OUTBOX_MAX_AGE old.
+        :return: seconds until the next post in the outbox is due, or None if the outbox is empty
+        """
+        now = timezone.now()
+        MatterMostOutboxPost.objects.filter(created__lt=now - timedelta(seconds=OUTBOX_MAX_AGE)).delete()
+        with transaction.atomic():
+            due = list(MatterMostOutboxPost.objects.select_for_update().filter(next_attempt__lte=now)
+                       .select_related('instance').order_by('id')[:OUTBOX_BATCH_SIZE])
+            # claim them, so a concurrent replay doesn't post them too
+            MatterMostOutboxPost.objects.filter(id__in=[p.id for p in due]) \
+                .update(next_attempt=now + timedelta(seconds=OUTBOX_MAX_RETRY_DELAY))
+
+        for outbox_post in due:
+            with metrics.alert_timer(u'outbox post {} to channel {}'.format(outbox_post.id,
+                                                                            outbox_post.channel_id)) as timer:
+                timer.outcome = self._replay_outbox_post(outbox_post)
+
+        next_post = MatterMostOutboxPost.objects.order_by('next_attempt').first()
+        if next_post is None:
+            return None
+        return max(0, (next_post.next_attempt - timezone.now()).total_seconds())
+
+    def _replay_outbox_post(self, outbox_post):
+        """
+        :param outbox_post: the MatterMostOutboxPost to send
+        :return: 'sent', 'dropped' (Mattermost rejected it), 'superseded' (a newer post replaced it) or 'failed'
+                 (to be retried)
+        """
+        if not MatterMostOutboxPost.objects.filter(id=outbox_post.id).exists():
+            # a newer post about its services was sent or saved since we claimed this one, don't post stale news
+            return 'superseded'
+
+        post = json.loads(outbox_post.payload)
+        client = _get_mm_client_for_instance(outbox_post.instance)
+        try:
+            response = client.post('posts', essential=True, idempotent=False, json=post)
+            if response.status_code == 400 and (post.get('file_ids') or post.get('root_id')):
+                # the files or the thread may be gone by now, post without them
+                post.pop('root_id', None)
+                post['file_ids'] = []
+                response = client.post('posts', essential=True, idempotent=False, json=post)
+            _check_response(response)
+        except requests.RequestException as e:
+            if not _is_retryable(e):
+                logger.exception('Mattermost rejected outbox post %s, dropping it.', outbox_post.id)
+                outbox_post.delete()
+                metrics.incr('outbox.dropped')
+                return 'dropped'
+            # (the post may have been superseded meanwhile, then there's nothing to update)
+            MatterMostOutboxPost.objects.filter(id=outbox_post.id).update(
+                attempts=outbox_post.attempts + 1,
+                next_attempt=timezone.now() + timedelta(seconds=_outbox_delay(outbox_post.attempts + 1)),
+                last_error=unicode(e)[:1000])
+            return 'failed'
+        outbox_post.delete()
+        metrics.incr('outbox.replayed')
+        return 'sent'
+
+    def _post_digest(self, instance, channel_id, pending):
+        """
+        Post a single summary of the alerts buffered for a channel in digest mode: every service with its status
+        and failing checks, and one line @mentioning everyone who was alerted (once each).
+        :param instance: the MatterMostInstance
+        :param channel_id: channel ID to post in
+        :param pending: the latest MatterMostPendingAlert of every service, in the order they were queued
+        :return: None
+        """
+        with metrics.alert_timer('digest of {} services in channel {}'.format(len(pending), channel_id)) as timer:
+            users_to_add = set()
+            mentions = set()
+            for p in pending:
+                aliases = json.loads(p.users_to_add)
+                users_to_add.update(aliases)
+                if p.alert:
+                    mentions.update(aliases)
+
+            with metrics.stage('failing_checks'):
+                failing_checks = _get_failing_checks_bulk([p.service for p in pending])
+                services = [(p.service, p.status, EMOJIS.get(p.status), failing_checks[p.service_id]) for p in pending]
+
+            with metrics.stage('render'):
+                message = _compile_template(DIGEST_TEMPLATE).render(Context({
+                    'services': services,
+                    'users': sorted(mentions),
+                    'host': settings.WWW_HTTP_HOST,
+                    'scheme': settings.WWW_SCHEME,
+                }))
+            statuses = set(p.status for p in pending)
+            worst = next((status for status in STATUS_SEVERITY if status in statuses), pending[0].status)
+            attachment = {
+                'fallback': '{} services changed status'.format(len(pending)),
+                'color': COLORS.get(worst),
+                'text': message,
+            }
+
+            url, headers = _get_mm_api_for_instance(instance)
+            # no status images: a digest can cover dozens of services
+            self._post_attachments(url, headers, channel_id, [attachment], sorted(users_to_add), [],
+                                   outbox=(instance, [p.service for p in pending]),
+                                   client=_get_mm_client_for_instance(instance))
+            timer.outcome = 'sent'
+
+    def _deliver_alert(self, service, message, aliases, alert, failing_checks):
+        """
+        Send a rendered alert, or queue it if the service's instance uses async delivery or its channel is in
+        digest mode.
+        :param failing_checks: list of (check, last_result) tuples
+        :return: 'queued' or 'sent'
+        """
+        instance = service.mattermost_instance
+        if instance is not None and (_get_instance_settings(instance).async_delivery or
+                                     _get_channel_digest(instance, _get_mm_api_for_service(service)[2])):
+            self._queue_alert(service, message, aliases, alert=alert)
+            return 'queued'
+        self._send_alert(service, message, aliases, failing_checks=[check for check, _ in failing_checks])
+        return 'sent'
+
+    def render_alerts(self, alerts):
+        """
+        Render the alerts for a batch of services, looking up users' aliases, failing checks and message templates
+        for the whole batch at once (instead of per service, like send_alert).
+        :param alerts: list of (service, users) tuples, users being everyone to alert (including duty officers)
+        :return: OrderedDict of (MatterMostInstance id, channel ID) -> list of RenderedAlerts, in the order given;
+                 services whose status change doesn't need a message are left out
+        """
+        to_render = [(service, users, _should_alert(service)) for service, users in alerts]
+        to_render = [(service, users, alert) for service, users, alert in to_render if alert is not None]
+        services = [service for service, _, _ in to_render]
+
+        with metrics.stage('users'):
+            alias_entries = _resolve_alias_entries([user for _, users, _ in to_render for user in users])
+        with metrics.stage('failing_checks'):
+            failing_checks = _get_failing_checks_bulk(services)
+        templates = _get_message_templates(services)
+
+        groups = OrderedDict()
+        for service, users, alert in to_render:
+            try:
+                _, _, channel_id = _get_mm_api_for_service(service)
+            except RuntimeError as e:
+                logger.warn('Not sending the alert for service %s: %s', service.name, e)
+                continue
+            aliases, missing_aliases = _aliases_from_entries(alias_entries, users)
+            with metrics.stage('render'):
+                message = _render_message(service, templates[service.id], aliases, missing_aliases, alert,
+                                          failing_checks[service.id])
+            groups.setdefault((service.mattermost_instance_id, channel_id), []).append(
+                RenderedAlert(service, message, aliases, alert, failing_checks[service.id]))
+        return groups
+
+    def send_alerts(self, alerts):
+        """
+        Render (see render_alerts) and send the alerts for a batch of services, a channel at a time: everyone
+        @mentioned in a channel is added to it with one lookup, then the channel's posts go out over its instance's
+        pooled connection.
+        :param alerts: list of (service, users) tuples, users being everyone to alert (including duty officers)
+        :return: None
+        """
+        with metrics.alert_timer('batch of {} services'.format(len(alerts))) as timer:
+            groups = self.render_alerts(alerts)
+            timer.outcome = 'rendered'
+
+        for (_, channel_id), rendered in groups.items():
+            url, headers, _ = _get_mm_api_for_service(rendered[0].service)
+            client = _get_mm_client(rendered[0].service)
+            instance = rendered[0].service.mattermost_instance
+            if not (_get_instance_settings(instance).async_delivery or _get_channel_digest(instance, channel_id)) \
+                    and client.breaker.state == CircuitBreaker.CLOSED:
+                try:
+                    with metrics.stage('add_users'):
+                        self._add_users_to_channel(url, headers, channel_id, sorted(set(
+                            alias for r in rendered for alias in r.aliases)) + [CABOT_USERNAME], client=client)
+                except requests.RequestException:
+                    logger.exception('Failed to add users to channel %s. Is the Cabot MM user an admin here?',
+                                     channel_id)
+
+            for r in rendered:
+                try:
+                    with metrics.alert_timer(r.service.name) as timer:
+                        timer.outcome = self._deliver_alert(r.service, r.message, r.aliases, r.alert,
+                                                            r.failing_checks)
+                except Exception:
+                    # don't let one service's failure stop the rest of the batch
+                    logger.exception('Failed to send the alert for service %s.', r.service.name)
+
+    def send_alert(self, service, users, duty_officers):
+        with metrics.alert_timer(service.name) as timer:
+            users = list(users) + list(duty_officers)
+
+            with metrics.stage('users'):
+                # users without a MatterMostAlertUserData object (or with an empty alias) end up in missing_aliases
+                aliases, missing_aliases = _resolve_aliases(users)
+
+            alert = _should_alert(service)
+            if alert is None:
                 return
-            # Don't @mention when transitioning into the ACKED status
-            alert = False
 
-        jenkins_api = urljoin(settings.JENKINS_API, '/')
-        c = Context({
-            'service': service,
-            'users': aliases,
-            'missing_aliases': missing_aliases,
-            'host': settings.WWW_HTTP_HOST,
-            'scheme': settings.WWW_SCHEME,
-            'alert': alert,
-            'jenkins_api': jenkins_api,
-            'status': current_status,
-            'emoji': emoji,
-        })
+            template = _get_message_template(service, _template_kind(service))
+
+            with metrics.stage('failing_checks'):
+                failing_checks = _get_failing_checks(service)
 
-        message = Template(template).render(c)
-        self._send_alert(service, message, aliases)
+            with metrics.stage('render'):
+                message = _render_message(service, template, aliases, missing_aliases, alert, failing_checks)
+            timer.outcome = self._deliver_alert(service, message, aliases, alert, failing_checks)
+
+
+def validate_message_template(source):
+    try:
+        Template(source)
+    except TemplateSyntaxError as e:
+        raise ValidationError('Invalid template: {}'.format(e))
 
 
 def validate_mattermost_alias(alias):
@@ -326,3 +1523,196 @@ class MatterMostAlertUserData(AlertPluginUserData):
 
     def is_configured(self):
         return bool(self.mattermost_alias)
+
+
+@receiver(post_save, sender=MatterMostAlertUserData)
+def _user_data_saved(sender, instance, **kwargs):
+    user = instance.user.user
+    _user_alias_changed(user.id, _user_alias_entry(user, instance))
+
+
+@receiver(post_delete, sender=MatterMostAlertUserData)
+def _user_data_deleted(sender, instance, **kwargs):
+    # the profile (and user) may be getting deleted too, so don't follow instance.user
+    for user in User.objects.filter(id__in=UserProfile.objects.filter(id=instance.user_id).values('user_id')):
+        _user_alias_changed(user.id, _user_alias_entry(user, None))
+
+
+# the User fields _user_alias_entry uses
+USER_ALIAS_FIELDS = frozenset(['first_name', 'last_name', 'email', 'username'])
+
+
+@receiver(post_save, sender=User)
+def _user_saved(sender, instance, raw=False, update_fields=None, **kwargs):
+    # fixtures are loaded raw, possibly before our tables exist. Saves that only update other fields (e.g. logins,
+    # which only update last_login) don't change the user's entry
+    if raw or (update_fields is not None and not USER_ALIAS_FIELDS.intersection(update_fields)):
+        return
+    mm_data = MatterMostAlertUserData.objects.filter(user__user=instance).first()
+    _user_alias_changed(instance.id, _user_alias_entry(instance, mm_data))
+
+
+@receiver(post_delete, sender=User)
+def _user_deleted(sender, instance, **kwargs):
+    _user_alias_changed(instance.id)
+
+
+class MatterMostInstanceSettings(models.Model):
+    '''
+    Plugin settings for a MatterMostInstance. Instances without settings use the defaults.
+    '''
+    instance = models.OneToOneField('cabotapp.MatterMostInstance', related_name='alert_settings',
+                                    on_delete=models.CASCADE)
+    max_concurrency = models.PositiveIntegerField(
+        default=1,
+        help_text='Max number of API calls/status image renders run in parallel for this instance (1 = serial).')
+    async_delivery = models.BooleanField(
+        default=False,
+        help_text='Deliver alerts from a celery task instead of from the check run, coalescing alerts for the same '
+                  'channel into a single post.')
+    coalesce_seconds = models.PositiveIntegerField(
+        default=10,
+        help_text='With async delivery, how long to wait for more alerts for the same channel before posting.')
+    thread_incidents = models.BooleanField(
+        default=False,
+        help_text='Post status changes as replies in a thread per incident (and update the thread\'s first post), '
+                  'instead of a new post for every status change. Not used for coalesced async deliveries.')
+    lazy_images = models.BooleanField(
+        default=False,
+        help_text='Instead of uploading status images with every alert, add "show graph" buttons and links to it, '
+                  'and only render and upload an image when someone asks for it.')
+    persistent_connection = models.BooleanField(
+        default=False,
+        help_text='Keep a connection to this instance open at all times, health checking it in the background and '
+                  'reconnecting when it fails, so alerts never wait for a new connection.')
+
+    def __unicode__(self):
+        return u'Settings for {}'.format(self.instance)
+
+
+@receiver(post_save, sender=MatterMostInstanceSettings)
+@receiver(post_delete, sender=MatterMostInstanceSettings)
+def _instance_settings_changed(sender, instance, **kwargs):
+    # drop the cached settings and client, so they're reloaded with the new settings
+    _instance_settings.delete(instance.instance_id)
+    forget_client(*_get_mm_api_for_instance(instance.instance))
+
+
+class MatterMostPendingAlert(models.Model):
+    '''
+    A rendered alert waiting to be delivered by tasks.deliver_pending_alerts (see MatterMostInstanceSettings.async_delivery).
+    '''
+    instance = models.ForeignKey('cabotapp.MatterMostInstance', on_delete=models.CASCADE)
+    channel_id = models.CharField(max_length=64)
+    service = models.ForeignKey('cabotapp.Service', on_delete=models.CASCADE)
+    status = models.CharField(max_length=50)
+    message = models.TextField()
+    users_to_add = models.TextField(help_text='JSON list of MM usernames to add to the channel.')
+    alert = models.BooleanField(default=True, help_text='Whether users_to_add are @mentioned (in a digest).')
+    created = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        index_together = (('instance', 'channel_id'),)
+
+
+class MatterMostChannelDigest(models.Model):
+    '''
+    Puts a channel in digest mode: alerts for it are buffered for window_seconds and posted as a single summary of
+    every service that alerted, instead of one post per alert. Delivered by tasks.deliver_pending_alerts.
+    '''
+    instance = models.ForeignKey('cabotapp.MatterMostInstance', on_delete=models.CASCADE)
+    channel_id = models.CharField(
+        max_length=64,
+        help_text='The channel (a service\'s Mattermost room ID, or the instance\'s default channel).')
+    window_seconds = models.PositiveIntegerField(
+        default=300,
+        help_text='How long to buffer alerts for the channel before posting the digest.')
+
+    class Meta:
+        unique_together = (('instance', 'channel_id'),)
+
+    def __unicode__(self):
+        return u'Digest for {} on {}'.format(self.channel_id, self.instance)
+
+
+@receiver(post_save, sender=MatterMostChannelDigest)
+@receiver(post_delete, sender=MatterMostChannelDigest)
+def _channel_digest_changed(sender, instance, **kwargs):
+    _channel_digests.delete((instance.instance_id, instance.channel_id))
+
+
+class MatterMostMessageTemplate(models.Model):
+    '''
+    A custom message template for a service or a whole Mattermost instance, used instead of
+    MESSAGE_TEMPLATE_NORMAL/MESSAGE_TEMPLATE_ALERT. Templates get the same context as the built in ones.
+    A service's own template takes precedence over its instance's.
+    '''
+    NORMAL = 'normal'
+    ALERT = 'alert'
+    KIND_CHOICES = (
+        (NORMAL, 'Back to normal'),
+        (ALERT, 'Alert'),
+    )
+
+    kind = models.CharField(max_length=10, choices=KIND_CHOICES)
+    instance = models.ForeignKey('cabotapp.MatterMostInstance', null=True, blank=True, on_delete=models.CASCADE,
+                                 help_text='Use this template for all services alerting to this instance.')
+    service = models.ForeignKey('cabotapp.Service', null=True, blank=True, on_delete=models.CASCADE,
+                                help_text='Use this template for this service only (takes precedence).')
+    template = models.TextField(validators=[validate_message_template])
+
+    class Meta:
+        unique_together = (('kind', 'instance', 'service'),)
+
+    def clean(self):
+        if (self.instance_id is None) == (self.service_id is None):
+            raise ValidationError('Set exactly one of instance or service.')
+        # unique_together doesn't cover this, since instance or service is always NULL (and NULLs are never equal)
+        duplicates = MatterMostMessageTemplate.objects.filter(kind=self.kind, instance_id=self.instance_id,
+                                                              service_id=self.service_id).exclude(pk=self.pk)
+        if duplicates.exists():
+            raise ValidationError('There already is a {} template for this {}.'.format(
+                self.get_kind_display().lower(), 'service' if self.service_id is not None else 'instance'))
+
+    def __unicode__(self):
+        return u'{} template for {}'.format(self.get_kind_display(), self.service or self.instance)
+
+
+@receiver(post_save, sender=MatterMostMessageTemplate)
+@receiver(post_delete, sender=MatterMostMessageTemplate)
+def _message_template_changed(sender, **kwargs):
+    # bump the generation so every process drops its cached templates
+    cache.set(MESSAGE_TEMPLATE_GENERATION_KEY, uuid.uuid4().hex, None)
+
+
+class MatterMostOutboxPost(models.Model):
+    '''
+    A post that failed because Mattermost was unavailable, waiting to be retried by tasks.replay_outbox.
+    A post is dropped once a newer post (sent or saved) for its channel covers all of its services.
+    '''
+    instance = models.ForeignKey('cabotapp.MatterMostInstance', on_delete=models.CASCADE)
+    channel_id = models.CharField(max_length=64)
+    services = models.ManyToManyField('cabotapp.Service', blank=True, related_name='mattermost_outbox_posts',
+                                      help_text='The services the post is about (several for coalesced alerts and '
+                                                'digests).')
+    payload = models.TextField(help_text='JSON body of the post (message, attachments and file IDs).')
+    attempts = models.PositiveIntegerField(default=0)
+    next_attempt = models.DateTimeField(db_index=True)
+    last_error = models.TextField(blank=True)
+    created = models.DateTimeField(auto_now_add=True)
+
+    def __unicode__(self):
+        return u'Outbox post to {} on {}'.format(self.channel_id, self.instance)
+
+
+class MatterMostIncidentPost(models.Model):
+    '''
+    The root post of the thread for a service's ongoing incident (see MatterMostInstanceSettings.thread_incidents).
+    '''
+    service = models.ForeignKey('cabotapp.Service', on_delete=models.CASCADE)
+    channel_id = models.CharField(max_length=64)
+    post_id = models.CharField(max_length=64)
+    created = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        unique_together = (('service', 'channel_id'),)
@@ -0,0 +1,38 @@
+from datetime import timedelta
+from os import environ as env
+
+from celery import shared_task
+from celery.task import periodic_task
+from celery.utils.log import get_task_logger
+
+logger = get_task_logger(__name__)
+
+# how often (seconds) celery beat runs replay_outbox, so the outbox is drained even if no new post fails
+OUTBOX_REPLAY_INTERVAL = int(env.get('MATTERMOST_OUTBOX_REPLAY_INTERVAL', 60))
+
+
+@shared_task(ignore_result=True)
+def deliver_pending_alerts(instance_id, channel_id):
+    """Post the alerts queued for a Mattermost channel (see MatterMostAlert._queue_alert)."""
+    from cabot.cabotapp.models_plugins import MatterMostInstance
+    from cabot_alert_mattermost.models import MatterMostAlert
+
+    try:
+        instance = MatterMostInstance.objects.get(id=instance_id)
+    except MatterMostInstance.DoesNotExist:
+        logger.warn('Mattermost instance %s was deleted, dropping its pending alerts.', instance_id)
+        return
+
+    MatterMostAlert.objects.get().deliver_pending_alerts(instance, channel_id)
+
+
+@periodic_task(run_every=timedelta(seconds=OUTBOX_REPLAY_INTERVAL), ignore_result=True)
+def replay_outbox():
+    """
+    Retry posts that failed while Mattermost was unavailable (see MatterMostAlert.replay_outbox).
+    Runs periodically, and is also scheduled whenever a post is saved to the outbox; posts that aren't due yet are
+    left alone, so extra runs are harmless.
+    """
+    from cabot_alert_mattermost.models import MatterMostAlert
+
+    MatterMostAlert.objects.get().replay_outbox()
@@ -0,0 +1,43 @@
+from unittest import TestCase
+
+from mock import patch
+
+from cabot_alert_mattermost.cache import TTLCache
+
+
+class TestTTLCache(TestCase):
+    def test_get_set(self):
+        cache = TTLCache(max_size=10, ttl=60)
+        self.assertIsNone(cache.get('a'))
+        cache.set('a', 1)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.stats(), {'hits': 1, 'misses': 1, 'size': 1})
+
+    def test_evicts_least_recently_used(self):
+        cache = TTLCache(max_size=2, ttl=60)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('c'), 3)
+
+    @patch('cabot_alert_mattermost.cache.time.time')
+    def test_expires(self, time):
+        cache = TTLCache(max_size=10, ttl=60)
+        time.return_value = 1000
+        cache.set('a', 1)
+        time.return_value = 1059
+        self.assertEqual(cache.get('a'), 1)
+        time.return_value = 1060
+        self.assertIsNone(cache.get('a'))
+
+    def test_delete_where(self):
+        cache = TTLCache(max_size=10, ttl=60)
+        cache.set(('channel', 'user1'), True)
+        cache.set(('channel', 'user2'), True)
+        cache.set(('other', 'user1'), True)
+        cache.delete_where(lambda key: key[0] == 'channel')
+        self.assertEqual(len(cache), 1)
+        self.assertTrue(cache.get(('other', 'user1')))
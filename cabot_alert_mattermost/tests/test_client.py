@@ -0,0 +1,211 @@
+from unittest import TestCase
+
+import requests
+from mock import patch, call, Mock
+
+from cabot_alert_mattermost import client
+from cabot_alert_mattermost.fake_server import FakeMatterMostServer
+
+
+def _response(status_code, headers=None):
+    return Mock(status_code=status_code, headers=headers or {})
+
+
+class TestMatterMostClient(TestCase):
+    def setUp(self):
+        client.reset_clients()
+        self.client = client.get_client('https://mattermost.org/api/v4/', {'Authorization': 'Bearer SOME-TOKEN'})
+
+    def tearDown(self):
+        client.reset_clients()
+
+    def test_get_client_is_shared_per_instance(self):
+        self.assertIs(client.get_client('https://mattermost.org/api/v4/', {'Authorization': 'Bearer SOME-TOKEN'}),
+                      self.client)
+        self.assertIsNot(client.get_client('https://mattermost.org/api/v4/', {'Authorization': 'Bearer OTHER'}),
+                         self.client)
+        self.assertEqual(self.client.session.headers['Authorization'], 'Bearer SOME-TOKEN')
+
+    def test_get_client_is_replaced_when_its_options_change(self):
+        url, headers = 'https://mattermost.org/api/v4/', {'Authorization': 'Bearer SOME-TOKEN'}
+        self.assertIs(client.get_client(url, headers, options={'max_concurrency': client.MAX_CONCURRENCY}),
+                      self.client)
+
+        with patch.object(self.client, 'close') as close:
+            new_client = client.get_client(url, headers, options={'max_concurrency': 4})
+        close.assert_called_once_with()
+        self.assertEqual(new_client.max_concurrency, 4)
+        # callers that don't care about the options get the current client
+        self.assertIs(client.get_client(url, headers), new_client)
+
+    @patch('cabot_alert_mattermost.client.requests.Session.request')
+    def test_request_sets_timeout(self, request):
+        request.return_value = _response(201)
+        self.client.post('posts', json={})
+        request.assert_called_once_with('POST', 'https://mattermost.org/api/v4/posts', json={},
+                                        timeout=(client.CONNECT_TIMEOUT, client.READ_TIMEOUT))
+
+    @patch('cabot_alert_mattermost.client.time.sleep')
+    @patch('cabot_alert_mattermost.client.requests.Session.request')
+    def test_retries_rate_limited_requests(self, request, sleep):
+        request.side_effect = [_response(429, {'X-RateLimit-Reset': '3'}), _response(502), _response(201)]
+        response = self.client.post('posts', json={})
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(request.call_count, 3)
+        sleep.assert_has_calls([call(3.0), call(client.RETRY_BACKOFF * 2)])
+
+    @patch('cabot_alert_mattermost.client.time.sleep')
+    @patch('cabot_alert_mattermost.client.requests.Session.request')
+    def test_gives_up_after_max_retries(self, request, sleep):
+        request.return_value = _response(503)
+        response = self.client.post('posts', json={})
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(request.call_count, client.MAX_RETRIES + 1)
+
+    @patch('cabot_alert_mattermost.client.time.sleep')
+    @patch('cabot_alert_mattermost.client.requests.Session.request')
+    def test_does_not_retry_client_errors(self, request, sleep):
+        request.return_value = _response(403)
+        self.assertEqual(self.client.post('posts', json={}).status_code, 403)
+        self.assertEqual(request.call_count, 1)
+        self.assertFalse(sleep.called)
+
+    @patch('cabot_alert_mattermost.client.time.sleep')
+    @patch('cabot_alert_mattermost.client.requests.Session.request')
+    def test_retries_connection_errors(self, request, sleep):
+        request.side_effect = [requests.ConnectionError(), _response(201)]
+        self.assertEqual(self.client.post('posts', json={}).status_code, 201)
+
+    @patch('cabot_alert_mattermost.client.time.sleep')
+    @patch('cabot_alert_mattermost.client.requests.Session.request')
+    def test_non_idempotent_requests_are_only_retried_if_not_processed(self, request, sleep):
+        # the post may have been created before the server or a proxy failed
+        request.side_effect = [_response(502)]
+        self.assertEqual(self.client.post('posts', idempotent=False, json={}).status_code, 502)
+        request.side_effect = [requests.ConnectionError('Connection aborted.')]
+        self.assertRaises(requests.ConnectionError, self.client.post, 'posts', idempotent=False, json={})
+
+        # the server can't have acted on these
+        request.reset_mock()
+        request.side_effect = [_response(503), requests.ConnectTimeout(), _response(429), _response(201)]
+        self.assertEqual(self.client.post('posts', idempotent=False, json={}).status_code, 201)
+        self.assertEqual(request.call_count, 4)
+
+    def test_map_serial(self):
+        self.assertEqual(self.client.map(lambda x: x * 2, [1, 2, 3]), [2, 4, 6])
+        self.assertIsNone(self.client._pool)
+
+    def test_map_concurrent(self):
+        c = client.MatterMostClient('https://mattermost.org/api/v4/', {}, max_concurrency=3)
+        try:
+            self.assertEqual(c.map(lambda x: x * 2, [1, 2, 3]), [2, 4, 6])
+            self.assertIsNotNone(c._pool)
+        finally:
+            c.close()
+
+    def test_forget_client(self):
+        client.forget_client('https://mattermost.org/api/v4/', {'Authorization': 'Bearer SOME-TOKEN'})
+        self.assertIsNot(client.get_client('https://mattermost.org/api/v4/', {'Authorization': 'Bearer SOME-TOKEN'}),
+                         self.client)
+
+    @patch('cabot_alert_mattermost.client.requests.Session.request')
+    def test_server_version(self, request):
+        request.return_value = _response(200, {'X-Version-Id': '9.5.0.9.5.0.abc123.false'})
+        self.assertEqual(self.client.server_version(), (9, 5, 0))
+        self.assertTrue(self.client.supports_bulk_channel_members())
+        self.client.server_version()
+        self.assertEqual(request.call_count, 1)
+
+    @patch('cabot_alert_mattermost.client.time.sleep')
+    @patch('cabot_alert_mattermost.client.time.time')
+    @patch('cabot_alert_mattermost.client.requests.Session.request')
+    def test_server_version_unknown(self, request, time, sleep):
+        time.return_value = 1000
+        request.return_value = _response(200)
+        self.assertIsNone(self.client.server_version())
+        self.assertFalse(self.client.supports_bulk_channel_members())
+        # not looked up again on every call
+        self.assertEqual(request.call_count, 1)
+
+        time.return_value += client.CAPABILITY_RETRY_INTERVAL
+        request.return_value = _response(200, {'X-Version-Id': '9.5.0.9.5.0.abc123.false'})
+        self.assertTrue(self.client.supports_bulk_channel_members())
+        self.assertEqual(request.call_count, 2)
+
+    @patch('cabot_alert_mattermost.client.time.time')
+    def test_pause_bulk_channel_members(self, time):
+        time.return_value = 1000
+        self.client.bulk_channel_members = True
+        self.client.pause_bulk_channel_members()
+        self.assertFalse(self.client.supports_bulk_channel_members())
+        time.return_value += client.CAPABILITY_RETRY_INTERVAL
+        self.assertTrue(self.client.supports_bulk_channel_members())
+
+    @patch('cabot_alert_mattermost.client.time.sleep')
+    @patch('cabot_alert_mattermost.client.requests.Session.request')
+    def test_circuit_breaker(self, request, sleep):
+        request.return_value = _response(503)
+        for _ in range(client.BREAKER_FAILURE_THRESHOLD):
+            self.client.post('posts', json={})
+        self.assertEqual(self.client.breaker.state, client.CircuitBreaker.OPEN)
+        self.assertEqual(client.breaker_states(), {'https://mattermost.org/api/v4/': client.CircuitBreaker.OPEN})
+
+        # while open, nothing goes through
+        request.reset_mock()
+        self.assertRaises(client.MatterMostUnavailable, self.client.post, 'posts', essential=True, json={})
+        self.assertFalse(request.called)
+
+        # once half open, only essential calls are let through, and a success closes the breaker
+        self.client.breaker.opened_at -= client.BREAKER_RESET_TIMEOUT
+        self.assertEqual(self.client.breaker.state, client.CircuitBreaker.HALF_OPEN)
+        self.assertRaises(client.MatterMostUnavailable, self.client.post, 'channels/x/members', json={})
+        request.return_value = _response(201)
+        self.client.post('posts', essential=True, json={})
+        self.assertEqual(self.client.breaker.state, client.CircuitBreaker.CLOSED)
+
+    @patch('cabot_alert_mattermost.client.time.sleep')
+    @patch('cabot_alert_mattermost.client.time.time')
+    def test_token_bucket(self, time, sleep):
+        time.return_value = 1000
+        bucket = client.TokenBucket(rate=2, burst=2)
+        bucket.acquire()
+        bucket.acquire()
+        self.assertFalse(sleep.called)
+        bucket.acquire()
+        sleep.assert_called_once_with(0.5)
+
+    @patch('cabot_alert_mattermost.client.time.sleep')
+    def test_fake_server(self, sleep):
+        with FakeMatterMostServer() as server:
+            c = client.MatterMostClient(server.url + 'api/v4/', {})
+            try:
+                self.assertEqual(c.server_version(), (9, 5, 0))
+                self.assertEqual(c.post('posts', json={'message': 'hi'}).json()['message'], 'hi')
+
+                server.error_rate = 1
+                self.assertEqual(c.post('posts', json={}).status_code, 503)
+            finally:
+                c.close()
+        self.assertEqual(server.requests, {('GET', '/api/v4/system/ping'): 1,
+                                           ('POST', '/api/v4/posts'): client.MAX_RETRIES + 2})
+
+    def test_persistent_connection(self):
+        with FakeMatterMostServer() as server:
+            # health checks are run by hand below
+            with patch.object(client.ConnectionKeeper, 'start') as start:
+                c = client.MatterMostClient(server.url + 'api/v4/', {}, keepalive_interval=60)
+            start.assert_called_once_with()
+            try:
+                self.assertIsInstance(c.session.get_adapter(server.url), client.KeepAliveAdapter)
+                self.assertTrue(c.keeper.check())
+                self.assertEqual(c.keeper.healthy, True)
+
+                with patch.object(c, 'reconnect') as reconnect:
+                    server.error_rate = 1
+                    self.assertFalse(c.keeper.check())
+                    reconnect.assert_called_once_with()
+            finally:
+                c.close()
+            self.assertTrue(c.keeper._stopped.is_set())
+
+        self.assertIsNone(self.client.keeper)
@@ -1,16 +1,37 @@
 # -*- coding: utf-8 -*-
+import json
+import re
+import threading
+import time
+from datetime import timedelta
+from urlparse import parse_qs, urlparse
+
+import requests
 from cabot.cabotapp.alert import AlertPlugin
 from cabot.cabotapp.models_plugins import MatterMostInstance
 from cabot.plugin_test_utils import PluginTestCase
-from mock import patch, call
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
+from django.db import connection
+from django.test import RequestFactory
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from mock import patch, call, Mock
 
-from cabot.cabotapp.models import Service, UserProfile
-from cabot_alert_mattermost import models
+from cabot.cabotapp.models import Service, StatusCheck, StatusCheckResult, UserProfile
+from cabot_alert_mattermost import client, metrics, models, views
 
 
 class TestMattermostAlerts(PluginTestCase):
     def setUp(self):
         super(TestMattermostAlerts, self).setUp()
+        client.reset_clients()
+        models._instance_settings.clear()
+        models._message_templates.clear()
+        models._channel_digests.clear()
+        models._user_aliases.clear()
+        cache.clear()
 
         self.alert = AlertPlugin.objects.get(title=models.MatterMostAlert.name)
         self.service.alerts.add(self.alert)
@@ -38,28 +59,31 @@ class TestMattermostAlerts(PluginTestCase):
         })
         self.assertEqual(channel_id, 'better-channel')
 
-    @patch('cabot_alert_mattermost.models.requests')
+    @patch('cabot_alert_mattermost.client.MatterMostClient.post')
     @patch('cabot_alert_mattermost.models.MatterMostAlert._add_users_to_channel')
     @patch('cabot_alert_mattermost.models.MatterMostAlert._upload_files')
-    def test_passing_to_error(self, upload_files, add_users, requests):
-        upload_files.side_effect = lambda a, b, c, files: [str(i) for i, _ in enumerate(files)]
+    def test_passing_to_error(self, upload_files, add_users, post):
+        upload_files.side_effect = lambda a, b, c, files, client: [str(i) for i, _ in enumerate(files)]
 
         self.run_checks([(self.es_check, False, False)], Service.PASSING_STATUS)
 
+        mm_client = models._get_mm_client(self.service)
         add_users.assert_has_calls([
             call('https://mattermost.org/api/v4/',
                  {'Authorization': 'Bearer SOME-TOKEN'},
                  'better-channel',
-                 ['testuser_alias', 'cabot']),
+                 ['testuser_alias', 'cabot'],
+                 client=mm_client),
         ])
         upload_files.assert_has_calls([
             call('https://mattermost.org/api/v4/',
                  {'Authorization': 'Bearer SOME-TOKEN'},
                  'better-channel',
-                 [('ES Metric Check.png', self.es_check.get_status_image())]),
+                 [('ES Metric Check.png', self.es_check.get_status_image())],
+                 client=mm_client),
         ])
-        requests.post.assert_has_calls([
-            call('https://mattermost.org/api/v4/posts', headers={'Authorization': 'Bearer SOME-TOKEN'},
+        post.assert_has_calls([
+            call('posts', essential=True, idempotent=False,
                  json={
                      'channel_id': 'better-channel',
                      'message': '',
@@ -84,6 +108,118 @@ class TestMattermostAlerts(PluginTestCase):
             call().raise_for_status(),
         ])
 
+    @patch('cabot_alert_mattermost.client.MatterMostClient.post')
+    def test_add_users_to_channel_is_cached(self, post):
+        def fake_post(path, json):
+            if path == 'users/usernames':
+                return Mock(status_code=200, json=lambda: [{'username': 'testuser_alias', 'id': 'user-id'}])
+            return Mock(status_code=201)
+        post.side_effect = fake_post
+
+        url, headers, channel_id = models._get_mm_api_for_service(self.service)
+        for _ in range(3):
+            self.plugin._add_users_to_channel(url, headers, channel_id, ['testuser_alias', 'not_on_mm'])
+
+        self.assertEqual(post.call_args_list, [
+            call('users/usernames', json=['not_on_mm', 'testuser_alias']),
+            call('channels/better-channel/members', json={'user_id': 'user-id'}),
+        ])
+        stats = client.get_client(url, headers).cache_stats()
+        self.assertEqual(stats['user_ids']['hits'], 4)
+        self.assertEqual(stats['channel_members']['hits'], 2)
+
+    @patch('cabot_alert_mattermost.client.MatterMostClient.post')
+    def test_add_users_to_channel_forgets_user_on_403(self, post):
+        def fake_post(path, json):
+            if path == 'users/usernames':
+                return Mock(status_code=200, json=lambda: [{'username': 'testuser_alias', 'id': 'user-id'}])
+            return Mock(status_code=403)
+        post.side_effect = fake_post
+
+        url, headers, channel_id = models._get_mm_api_for_service(self.service)
+        self.plugin._add_users_to_channel(url, headers, channel_id, ['testuser_alias'])
+        self.plugin._add_users_to_channel(url, headers, channel_id, ['testuser_alias'])
+
+        self.assertEqual(post.call_args_list, [
+            call('users/usernames', json=['testuser_alias']),
+            call('channels/better-channel/members', json={'user_id': 'user-id'}),
+        ] * 2)
+
+    def test_instance_settings(self):
+        self.assertEqual(models._get_mm_client(self.service).max_concurrency, 1)
+
+        models.MatterMostInstanceSettings.objects.create(instance=self.mm_instance, max_concurrency=4)
+        self.assertEqual(models._get_mm_client(self.service).max_concurrency, 4)
+
+    def test_instance_settings_changed_by_another_process(self):
+        mm_client = models._get_mm_client(self.service)
+        self.assertIs(models._get_mm_client(self.service), mm_client)
+
+        # the settings signal only runs in the process that saved them, other processes see the new settings
+        # once their cached ones expire
+        with patch('cabot_alert_mattermost.models.forget_client'):
+            models.MatterMostInstanceSettings.objects.create(instance=self.mm_instance, max_concurrency=4)
+        self.assertEqual(models._get_mm_client(self.service).max_concurrency, 4)
+        self.assertIsNot(models._get_mm_client(self.service), mm_client)
+
+    @patch('cabot_alert_mattermost.client.ConnectionKeeper.start')
+    def test_persistent_connection_can_be_toggled(self, start_keeper):
+        self.assertIsNone(models._get_mm_client(self.service).keeper)
+
+        # the worker running the alerts isn't the process that saved the settings
+        with patch('cabot_alert_mattermost.models.forget_client'):
+            instance_settings = models.MatterMostInstanceSettings.objects.create(instance=self.mm_instance,
+                                                                                 persistent_connection=True)
+        mm_client = models._get_mm_client(self.service)
+        self.assertEqual(mm_client.keeper.interval, client.KEEPALIVE_INTERVAL)
+        start_keeper.assert_called_once_with()
+
+        with patch('cabot_alert_mattermost.models.forget_client'):
+            instance_settings.persistent_connection = False
+            instance_settings.save()
+        self.assertIsNone(models._get_mm_client(self.service).keeper)
+        self.assertTrue(mm_client.keeper._stopped.is_set())
+
+    @patch('cabot_alert_mattermost.client.MatterMostClient.get')
+    @patch('cabot_alert_mattermost.client.MatterMostClient.post')
+    def test_add_users_to_channel_in_bulk(self, post, get):
+        get.return_value = Mock(status_code=200, headers={'X-Version-Id': '9.5.0.9.5.0.abc123.false'})
+
+        def fake_post(path, json):
+            if path == 'users/usernames':
+                return Mock(status_code=200, json=lambda: [{'username': 'cabot', 'id': 'cabot-id'},
+                                                           {'username': 'testuser_alias', 'id': 'user-id'}])
+            return Mock(status_code=201, json=lambda: [{'user_id': 'cabot-id', 'channel_id': 'better-channel'}])
+        post.side_effect = fake_post
+
+        url, headers, channel_id = models._get_mm_api_for_service(self.service)
+        result = self.plugin._add_users_to_channel(url, headers, channel_id, ['testuser_alias', 'cabot', 'not_on_mm'])
+
+        post.assert_called_with('channels/better-channel/members', json={'user_ids': ['cabot-id', 'user-id']})
+        self.assertEqual(result, models.ChannelMembershipResult(added=['cabot'], failed={'testuser_alias': None},
+                                                                not_found=['not_on_mm']))
+
+    @patch('cabot_alert_mattermost.client.MatterMostClient.get')
+    @patch('cabot_alert_mattermost.client.MatterMostClient.post')
+    def test_add_users_to_channel_on_old_server(self, post, get):
+        get.return_value = Mock(status_code=200, headers={'X-Version-Id': '5.31.0.5.31.0.abc123.false'})
+
+        def fake_post(path, json):
+            if path == 'users/usernames':
+                return Mock(status_code=200, json=lambda: [{'username': 'cabot', 'id': 'cabot-id'},
+                                                           {'username': 'testuser_alias', 'id': 'user-id'}])
+            return Mock(status_code=201)
+        post.side_effect = fake_post
+
+        url, headers, channel_id = models._get_mm_api_for_service(self.service)
+        result = self.plugin._add_users_to_channel(url, headers, channel_id, ['testuser_alias', 'cabot'])
+
+        post.assert_has_calls([
+            call('channels/better-channel/members', json={'user_id': 'cabot-id'}),
+            call('channels/better-channel/members', json={'user_id': 'user-id'}),
+        ])
+        self.assertEqual(result.added, ['cabot', 'testuser_alias'])
+
     @patch('cabot_alert_mattermost.models.MatterMostAlert._send_alert')
     def test_passing_to_warning(self, send_alert):
         self.transition_service_status(Service.PASSING_STATUS, Service.WARNING_STATUS)
@@ -91,7 +227,7 @@ class TestMattermostAlerts(PluginTestCase):
             call(self.service, '\n'
                                '### Service\n'
                                '**[Service](http://localhost/service/2194/) is reporting WARNING** :thinking:\n\n'
-                               '##### Failing checks\n', ['testuser_alias']),
+                               '##### Failing checks\n', ['testuser_alias'], failing_checks=[]),
         ])
 
     @patch('cabot_alert_mattermost.models.MatterMostAlert._send_alert')
@@ -102,7 +238,7 @@ class TestMattermostAlerts(PluginTestCase):
                                '### Service\n'
                                '**[Service](http://localhost/service/2194/) is reporting ACKED** :zipper_mouth_face:\n'
                                '\n'
-                               '##### Failing checks\n', ['testuser_alias']),
+                               '##### Failing checks\n', ['testuser_alias'], failing_checks=[]),
         ])
 
     @patch('cabot_alert_mattermost.models.MatterMostAlert._send_alert')
@@ -120,4 +256,554 @@ class TestMattermostAlerts(PluginTestCase):
     @patch('cabot_alert_mattermost.models.MatterMostAlert._send_alert')
     def test_acked_to_passing(self, send_alert):
         self.transition_service_status(Service.ACKED_STATUS, Service.PASSING_STATUS)
-        self.assertFalse(send_alert.called)
\ No newline at end of file
+        self.assertFalse(send_alert.called)
+
+    @patch('cabot_alert_mattermost.models.MatterMostAlert._send_alert')
+    def test_custom_message_templates(self, send_alert):
+        models.MatterMostMessageTemplate.objects.create(kind=models.MatterMostMessageTemplate.ALERT,
+                                                        instance=self.mm_instance,
+                                                        template='{{ service.name }} is {{ status }}')
+        self.transition_service_status(Service.PASSING_STATUS, Service.ERROR_STATUS)
+        self.assertEqual(send_alert.call_args[0][1], 'Service is ERROR')
+
+        # the service's own template takes precedence, and saving it invalidates the cached one
+        models.MatterMostMessageTemplate.objects.create(kind=models.MatterMostMessageTemplate.ALERT,
+                                                        service=self.service,
+                                                        template='{{ emoji }} {{ service.name }}')
+        self.transition_service_status(Service.PASSING_STATUS, Service.ERROR_STATUS)
+        self.assertEqual(send_alert.call_args[0][1], ':sad-panda: Service')
+
+    @patch('cabot_alert_mattermost.models.cache.get')
+    def test_message_template_changed_by_another_process(self, cache_get):
+        # e.g. the local memory cache backend, where other processes' generation bumps aren't seen
+        cache_get.return_value = None
+        kind = models.MatterMostMessageTemplate.ALERT
+        self.assertIs(models._get_message_template(self.service, kind),
+                      models._compile_template(models.MESSAGE_TEMPLATE_ALERT))
+        models.MatterMostMessageTemplate.objects.create(kind=kind, service=self.service, template='{{ emoji }}')
+
+        # the change shows up once the cached template expires
+        expired = time.time() + models.MESSAGE_TEMPLATE_LOCAL_TTL
+        with patch('cabot_alert_mattermost.cache.time.time', return_value=expired):
+            self.assertIs(models._get_message_template(self.service, kind), models._compile_template('{{ emoji }}'))
+
+    def test_duplicate_message_templates(self):
+        kind = models.MatterMostMessageTemplate.ALERT
+        models.MatterMostMessageTemplate.objects.create(kind=kind, instance=self.mm_instance, template='{{ emoji }}')
+        duplicate = models.MatterMostMessageTemplate(kind=kind, instance=self.mm_instance, template='{{ status }}')
+        self.assertRaises(ValidationError, duplicate.clean)
+        # other kinds are fine
+        models.MatterMostMessageTemplate(kind=models.MatterMostMessageTemplate.NORMAL, instance=self.mm_instance,
+                                         template='{{ status }}').clean()
+
+    def test_message_template_is_compiled_once(self):
+        alert = models._get_message_template(self.service, models.MatterMostMessageTemplate.ALERT)
+        self.assertIs(models._get_message_template(self.service, models.MatterMostMessageTemplate.ALERT), alert)
+        self.assertIs(models._compile_template(models.MESSAGE_TEMPLATE_ALERT), alert)
+
+    @patch('cabot_alert_mattermost.models.MatterMostAlert._send_alert')
+    def test_send_alert_query_count(self, send_alert):
+        self.service.overall_status = Service.ERROR_STATUS
+        self.service.old_overall_status = Service.PASSING_STATUS
+
+        def count_queries(users):
+            with CaptureQueriesContext(connection) as queries:
+                self.plugin.send_alert(self.service, users, [])
+            return len(queries)
+
+        # warm up the template cache
+        count_queries([self.user])
+        num_queries = count_queries([self.user])
+        self.assertLessEqual(num_queries, 5)
+
+        users = [self.user]
+        for i in range(5):
+            user = User.objects.create(username='user{}'.format(i))
+            profile, _ = UserProfile.objects.get_or_create(user=user)
+            models.MatterMostAlertUserData.objects.create(user=profile, mattermost_alias='alias{}'.format(i))
+            users.append(user)
+        self.assertEqual(count_queries(users), num_queries)
+
+    def test_get_failing_checks(self):
+        self.run_checks([(self.es_check, False, False)], Service.PASSING_STATUS)
+        now = timezone.now()
+        StatusCheck.objects.filter(id=self.es_check.id).update(last_run=now)
+        latest = StatusCheckResult.objects.create(status_check=self.es_check, time=now,
+                                                  time_complete=now + timedelta(seconds=60), succeeded=False)
+        # created later, but completed earlier
+        StatusCheckResult.objects.create(status_check=self.es_check, time=now,
+                                         time_complete=now + timedelta(seconds=30), succeeded=False)
+
+        # the check, and its results around its last run
+        with self.assertNumQueries(2):
+            self.assertEqual(models._get_failing_checks(self.service), [(self.es_check, latest)])
+
+        # checks without a last_run fall back to check.last_result()
+        StatusCheck.objects.filter(id=self.es_check.id).update(last_run=None)
+        self.assertEqual(models._get_failing_checks(self.service), [(self.es_check, latest)])
+
+    def test_resolve_aliases(self):
+        other = User.objects.create(username='other', email='other@example.com')
+        self.assertEqual(models._resolve_aliases([self.user, other, self.user]),
+                         (['testuser_alias'], [('other@example.com', 'http://localhost/user/{}/profile/'
+                                                                     'MatterMost%20Plugin'.format(other.pk))]))
+
+        # resolved from memory after that
+        with self.assertNumQueries(0):
+            self.assertEqual(models._resolve_aliases([self.user, other])[0], ['testuser_alias'])
+
+        # and kept up to date when aliases change
+        profile, _ = UserProfile.objects.get_or_create(user=other)
+        mm_data = models.MatterMostAlertUserData.objects.create(user=profile, mattermost_alias='other_alias')
+        with self.assertNumQueries(0):
+            self.assertEqual(models._resolve_aliases([self.user, other]), (['testuser_alias', 'other_alias'], []))
+        mm_data.mattermost_alias = models.IGNORE_ALIAS
+        mm_data.save()
+        self.assertEqual(models._resolve_aliases([self.user, other]), (['testuser_alias'], []))
+        mm_data.delete()
+        self.assertEqual(len(models._resolve_aliases([self.user, other])[1]), 1)
+
+        # other processes only see the Django cache
+        models._user_aliases.clear()
+        with self.assertNumQueries(0):
+            self.assertEqual(models._resolve_aliases([self.user])[0], ['testuser_alias'])
+
+        # local copies expire, so changes made where they can't be signalled are picked up eventually
+        with patch('time.time', return_value=time.time() + models.USER_ALIAS_LOCAL_TTL + 1):
+            self.assertIsNone(models._user_aliases.get(self.user.id))
+
+        # a lookup that read the DB before an alias changed doesn't overwrite the new alias in the Django cache
+        models._user_alias_changed(self.user.id, ('new_alias', None))
+        models._user_aliases.clear()
+        with patch.object(models.cache, 'get_many', return_value={}):
+            self.assertEqual(models._resolve_aliases([self.user])[0], ['testuser_alias'])
+        self.assertEqual(cache.get(models.USER_ALIAS_KEY.format(self.user.id)), ('new_alias', None))
+
+    @patch('cabot_alert_mattermost.models._user_alias_changed')
+    def test_user_saves_that_dont_change_aliases(self, user_alias_changed):
+        # e.g. logins, and fixtures (which may be loaded before our tables exist)
+        self.user.save(update_fields=['last_login'])
+        models._user_saved(User, self.user, raw=True)
+        self.assertFalse(user_alias_changed.called)
+
+        self.user.save(update_fields=['email', 'last_login'])
+        self.assertEqual(user_alias_changed.call_count, 1)
+
+    @patch('cabot_alert_mattermost.models.tasks.deliver_pending_alerts')
+    @patch('cabot_alert_mattermost.models.MatterMostAlert._post_attachments')
+    def test_async_delivery_coalesces_alerts(self, post_attachments, deliver_pending_alerts):
+        models.MatterMostInstanceSettings.objects.create(instance=self.mm_instance, async_delivery=True,
+                                                         coalesce_seconds=30)
+        self.transition_service_status(Service.PASSING_STATUS, Service.ERROR_STATUS)
+        self.transition_service_status(Service.ERROR_STATUS, Service.ACKED_STATUS)
+
+        # only the first alert schedules a delivery
+        deliver_pending_alerts.apply_async.assert_called_once_with(args=[self.mm_instance.id, 'better-channel'],
+                                                                   countdown=30)
+        self.assertFalse(post_attachments.called)
+        self.assertEqual(models.MatterMostPendingAlert.objects.count(), 2)
+
+        self.plugin.deliver_pending_alerts(self.mm_instance, 'better-channel')
+        self.assertEqual(post_attachments.call_count, 1)
+        url, headers, channel_id, attachments, users_to_add, failing_checks = post_attachments.call_args[0]
+        self.assertEqual(channel_id, 'better-channel')
+        self.assertEqual([a['fallback'] for a in attachments], ['Service is ACKED'])
+        self.assertEqual(users_to_add, ['testuser_alias'])
+        self.assertFalse(models.MatterMostPendingAlert.objects.exists())
+
+    @patch('cabot_alert_mattermost.models.tasks.deliver_pending_alerts')
+    @patch('cabot_alert_mattermost.models.MatterMostAlert._post_attachments')
+    def test_lost_delivery_is_rescheduled(self, post_attachments, deliver_pending_alerts):
+        models.MatterMostInstanceSettings.objects.create(instance=self.mm_instance, async_delivery=True,
+                                                         coalesce_seconds=30)
+        self.transition_service_status(Service.PASSING_STATUS, Service.ERROR_STATUS)
+        self.transition_service_status(Service.ERROR_STATUS, Service.ACKED_STATUS)
+        self.assertEqual(deliver_pending_alerts.apply_async.call_count, 1)
+
+        # the delivery task was lost, the next alert notices the queued ones are overdue
+        models.MatterMostPendingAlert.objects.update(created=timezone.now() - timedelta(minutes=5))
+        self.transition_service_status(Service.ACKED_STATUS, Service.ERROR_STATUS)
+        self.assertEqual(deliver_pending_alerts.apply_async.call_args,
+                         call(args=[self.mm_instance.id, 'better-channel'], countdown=0))
+
+        # alerts left over after a delivery get a delivery of their own
+        deliver_pending_alerts.reset_mock()
+        with patch('cabot_alert_mattermost.models.MatterMostPendingAlert.objects.select_for_update') as select:
+            select.return_value.filter.return_value.select_related.return_value.order_by.return_value = []
+            self.plugin.deliver_pending_alerts(self.mm_instance, 'better-channel')
+        deliver_pending_alerts.apply_async.assert_called_once_with(args=[self.mm_instance.id, 'better-channel'],
+                                                                   countdown=30)
+
+    @patch('cabot_alert_mattermost.models.tasks.deliver_pending_alerts')
+    @patch('cabot_alert_mattermost.models.MatterMostAlert._post_attachments')
+    def test_channel_digest(self, post_attachments, deliver_pending_alerts):
+        models.MatterMostChannelDigest.objects.create(instance=self.mm_instance, channel_id='better-channel',
+                                                      window_seconds=120)
+        other_service = Service.objects.create(name='Other service', mattermost_instance=self.mm_instance,
+                                               mattermost_channel_id='better-channel')
+        self.transition_service_status(Service.PASSING_STATUS, Service.ERROR_STATUS)
+        other_service.old_overall_status = Service.PASSING_STATUS
+        other_service.overall_status = Service.ERROR_STATUS
+        self.plugin.send_alert(other_service, [self.user], [])
+
+        # alerts are buffered for the digest window, even without async delivery
+        deliver_pending_alerts.apply_async.assert_called_once_with(args=[self.mm_instance.id, 'better-channel'],
+                                                                   countdown=120)
+        self.assertFalse(post_attachments.called)
+
+        # the failing checks of all the services are fetched together
+        with patch('cabot_alert_mattermost.models._get_failing_checks_bulk',
+                   wraps=models._get_failing_checks_bulk) as get_failing_checks:
+            self.plugin.deliver_pending_alerts(self.mm_instance, 'better-channel')
+        self.assertEqual(get_failing_checks.call_count, 1)
+        self.assertEqual(post_attachments.call_count, 1)
+        url, headers, channel_id, attachments, users_to_add, failing_checks = post_attachments.call_args[0]
+        self.assertEqual(len(attachments), 1)
+        self.assertEqual(attachments[0]['fallback'], '2 services changed status')
+        self.assertEqual(attachments[0]['color'], models.COLORS['ERROR'])
+        text = attachments[0]['text']
+        self.assertIn('2 services changed status', text)
+        self.assertIn('[Service]', text)
+        self.assertIn('[Other service]', text)
+        # users alerted for both services are only mentioned once
+        self.assertEqual(text.count('@testuser_alias'), 1)
+        self.assertEqual(users_to_add, ['testuser_alias'])
+        self.assertEqual(failing_checks, [])
+
+    @patch('cabot_alert_mattermost.client.MatterMostClient.put')
+    @patch('cabot_alert_mattermost.client.MatterMostClient.post')
+    @patch('cabot_alert_mattermost.models.MatterMostAlert._add_users_to_channel')
+    @patch('cabot_alert_mattermost.models.MatterMostAlert._upload_files')
+    def test_thread_incidents(self, upload_files, add_users, post, put):
+        models.MatterMostInstanceSettings.objects.create(instance=self.mm_instance, thread_incidents=True)
+        upload_files.return_value = []
+        post.return_value = Mock(status_code=201, json=lambda: {'id': 'root-post'})
+        put.return_value = Mock(status_code=200)
+
+        # a new incident starts a thread
+        self.transition_service_status(Service.PASSING_STATUS, Service.ERROR_STATUS)
+        self.assertNotIn('root_id', post.call_args[1]['json'])
+        self.assertEqual(models.MatterMostIncidentPost.objects.get(service=self.service).post_id, 'root-post')
+
+        # later status changes reply in the thread and update the root post
+        self.transition_service_status(Service.ERROR_STATUS, Service.ACKED_STATUS)
+        self.assertEqual(post.call_args[1]['json']['root_id'], 'root-post')
+        self.assertEqual(put.call_args[0][0], 'posts/root-post/patch')
+        self.assertEqual(put.call_args[1]['json']['props']['attachments'][0]['fallback'], 'Service is ACKED')
+
+        # recovering ends the incident
+        self.transition_service_status(Service.ACKED_STATUS, Service.ERROR_STATUS)
+        self.transition_service_status(Service.ERROR_STATUS, Service.PASSING_STATUS)
+        self.assertEqual(post.call_args[1]['json']['root_id'], 'root-post')
+        self.assertFalse(models.MatterMostIncidentPost.objects.exists())
+
+    @patch('cabot_alert_mattermost.client.MatterMostClient.put')
+    @patch('cabot_alert_mattermost.client.MatterMostClient.post')
+    @patch('cabot_alert_mattermost.models.MatterMostAlert._add_users_to_channel')
+    def test_images_of_failed_posts_are_not_uploaded_again(self, add_users, post, put):
+        uploaded_ids = iter(['file-1', 'file-2', 'file-3', 'file-4'])
+        mm_down = [True]
+        attached = [[]]
+
+        def fake_post(path, **kwargs):
+            if path == 'files':
+                return Mock(status_code=201, json=lambda: {'file_infos': [{'id': next(uploaded_ids)}]})
+            if mm_down[0]:
+                raise client.MatterMostUnavailable('Mattermost is down')
+            return Mock(status_code=201, json=lambda: {'id': 'post', 'file_ids': attached[0]})
+        post.side_effect = fake_post
+        put.return_value = Mock(status_code=200)
+
+        url, headers, channel_id = models._get_mm_api_for_service(self.service)
+
+        def post_alert():
+            with patch('cabot_alert_mattermost.models._render_status_image',
+                       return_value=('check.png', 'image data')):
+                self.plugin._post_attachments(url, headers, channel_id, [], [], [self.es_check])
+
+        def uploads():
+            return [c for c in post.call_args_list if c[0][0] == 'files']
+
+        # the post fails, so the retry reuses the uploaded file
+        self.assertRaises(client.MatterMostUnavailable, post_alert)
+        mm_down[0] = False
+        attached[0] = ['file-1']
+        post_alert()
+        self.assertEqual(post.call_args[1]['json']['file_ids'], ['file-1'])
+        self.assertEqual(len(uploads()), 1)
+
+        # MM attaches a file to a single post, so the next post uploads it again
+        attached[0] = ['file-2']
+        post_alert()
+        self.assertEqual(post.call_args[1]['json']['file_ids'], ['file-2'])
+        self.assertEqual(len(uploads()), 2)
+        self.assertFalse(put.called)
+
+        # if MM doesn't attach a reused file after all, it's uploaded again and added to the post
+        mm_down[0] = True
+        self.assertRaises(client.MatterMostUnavailable, post_alert)
+        mm_down[0] = False
+        attached[0] = []
+        post_alert()
+        self.assertEqual(post.call_args_list[-2][1]['json']['file_ids'], ['file-3'])
+        put.assert_called_once_with('posts/post/patch', json={'file_ids': ['file-4']})
+
+    @patch('cabot_alert_mattermost.client.MatterMostClient.post')
+    def test_upload_files(self, post):
+        post.return_value = Mock(status_code=201, json=lambda: {'file_infos': [{'id': 'file-id'}]})
+        url, headers, channel_id = models._get_mm_api_for_service(self.service)
+
+        with patch('cabot_alert_mattermost.models.MAX_IMAGE_BYTES', 10):
+            file_ids = self.plugin._upload_files(url, headers, channel_id, [('small.png', 'small'),
+                                                                            ('huge.png', 'not a real png')])
+        # each file gets its own request, oversized files that can't be shrunk are skipped
+        self.assertEqual(file_ids, ['file-id'])
+        post.assert_called_once_with('files', params={'channel_id': 'better-channel', 'filename': 'small.png'},
+                                     data='small', timeout=(client.CONNECT_TIMEOUT, 30))
+
+    @patch('cabot_alert_mattermost.models.connection.close')
+    def test_closing_db_connection(self, close):
+        render = models._closing_db_connection(lambda check: check)
+        # map() runs single items in the calling thread, whose connection must stay open
+        self.assertEqual(render('check'), 'check')
+        self.assertFalse(close.called)
+
+        worker = threading.Thread(target=render, args=('check',))
+        worker.start()
+        worker.join()
+        close.assert_called_once_with()
+
+    @patch('cabot_alert_mattermost.client.MatterMostClient.post')
+    @patch('cabot_alert_mattermost.models.MatterMostAlert._add_users_to_channel')
+    @patch('cabot_alert_mattermost.models.MatterMostAlert._upload_files')
+    def test_open_circuit_breaker_only_posts_text(self, upload_files, add_users, post):
+        breaker = models._get_mm_client(self.service).breaker
+        for _ in range(breaker.failure_threshold):
+            breaker.record_failure()
+        breaker.opened_at -= breaker.reset_timeout
+
+        self.transition_service_status(Service.PASSING_STATUS, Service.ERROR_STATUS)
+        self.assertFalse(add_users.called)
+        self.assertFalse(upload_files.called)
+        self.assertEqual(post.call_args[0], ('posts',))
+        self.assertEqual(post.call_args[1]['essential'], True)
+
+    @patch('cabot_alert_mattermost.client.requests.Session.request')
+    @patch('cabot_alert_mattermost.models.MatterMostAlert._add_users_to_channel')
+    @patch('cabot_alert_mattermost.models.MatterMostAlert._upload_files')
+    def test_send_alert_metrics(self, upload_files, add_users, request):
+        request.return_value = Mock(status_code=201, headers={}, json=lambda: {'id': 'post-id'})
+        backend = metrics.InMemoryBackend()
+        metrics.set_backend(backend)
+        try:
+            self.transition_service_status(Service.PASSING_STATUS, Service.ERROR_STATUS)
+        finally:
+            metrics.set_backend(metrics.NullBackend())
+
+        self.assertEqual(backend.counters['mattermost.http.calls'], 1)
+        self.assertEqual(len(backend.timings['mattermost.alert.sent']), 1)
+        for stage in ('users', 'failing_checks', 'render', 'add_users', 'render_images', 'post'):
+            self.assertEqual(len(backend.timings['mattermost.stage.' + stage]), 1)
+
+    @patch('cabot_alert_mattermost.client.MatterMostClient.get')
+    @patch('cabot_alert_mattermost.client.MatterMostClient.post')
+    @patch('cabot_alert_mattermost.models.MatterMostAlert._add_users_to_channel')
+    @patch('cabot_alert_mattermost.models.MatterMostAlert._upload_files')
+    def test_lazy_images(self, upload_files, add_users, post, get):
+        models.MatterMostInstanceSettings.objects.create(instance=self.mm_instance, lazy_images=True)
+        self.run_checks([(self.es_check, False, False)], Service.PASSING_STATUS)
+
+        # the alert only offers the image
+        self.assertFalse(upload_files.called)
+        attachment = post.call_args[1]['json']['props']['attachments'][0]
+        self.assertIn(u'Graphs: [ES Metric Check](', attachment['text'])
+        action = attachment['actions'][0]
+        self.assertEqual(action['name'], 'Show graph: ES Metric Check')
+
+        def click(context, channel_id='better-channel'):
+            request = RequestFactory().post('/', json.dumps({'channel_id': channel_id, 'post_id': 'reply-id',
+                                                             'context': context}),
+                                            content_type='application/json')
+            return views.status_image_action(request)
+
+        context = action['integration']['context']
+        self.assertEqual(click(dict(context, token='forged')).status_code, 403)
+        # the button only works in the alert's channel
+        self.assertEqual(click(context, channel_id='other-channel').status_code, 403)
+        self.assertEqual(click(dict(context, channel_id='other-channel'), channel_id='other-channel').status_code, 403)
+        get.return_value = Mock(status_code=200, json=lambda: {'id': 'reply-id', 'channel_id': 'other-channel'})
+        self.assertEqual(click(context).status_code, 403)
+        # and expires
+        with patch('cabot_alert_mattermost.views.time.time', return_value=context['expires'] + 1):
+            self.assertIn('ephemeral_text', json.loads(click(context).content))
+        self.assertFalse(upload_files.called)
+
+        # clicking the button posts the image in the alert's thread
+        upload_files.return_value = ['file-id']
+        get.return_value = Mock(status_code=200, json=lambda: {'id': 'reply-id', 'root_id': 'root-id',
+                                                               'channel_id': 'better-channel'})
+        self.assertEqual(click(context).status_code, 200)
+        upload_files.assert_called_once_with('https://mattermost.org/api/v4/', {'Authorization': 'Bearer SOME-TOKEN'},
+                                             'better-channel',
+                                             [('ES Metric Check.png', self.es_check.get_status_image())],
+                                             client=models._get_mm_client(self.service))
+        self.assertEqual(post.call_args[1]['json']['root_id'], 'root-id')
+        self.assertEqual(post.call_args[1]['json']['file_ids'], ['file-id'])
+
+        # the links serve the image until they expire
+        link = urlparse(re.search(r'Graphs: \[ES Metric Check\]\(([^)]+)\)', attachment['text']).group(1))
+        query = dict((name, values[0]) for name, values in parse_qs(link.query).items())
+        self.assertEqual(views.status_image(RequestFactory().get(link.path, query), str(self.es_check.id)).content,
+                         self.es_check.get_status_image())
+        self.assertEqual(views.status_image(RequestFactory().get(link.path, dict(query, token='forged')),
+                                            str(self.es_check.id)).status_code, 403)
+        with patch('cabot_alert_mattermost.views.time.time', return_value=int(query['expires']) + 1):
+            self.assertEqual(views.status_image(RequestFactory().get(link.path, query),
+                                                str(self.es_check.id)).status_code, 403)
+
+    @patch('cabot_alert_mattermost.models.tasks.deliver_pending_alerts')
+    @patch('cabot_alert_mattermost.models.MatterMostAlert._post_attachments')
+    def test_lazy_images_with_async_delivery(self, post_attachments, deliver_pending_alerts):
+        models.MatterMostInstanceSettings.objects.create(instance=self.mm_instance, lazy_images=True,
+                                                         async_delivery=True)
+        self.run_checks([(self.es_check, False, False)], Service.PASSING_STATUS)
+
+        self.plugin.deliver_pending_alerts(self.mm_instance, 'better-channel')
+        url, headers, channel_id, attachments, users_to_add, failing_checks = post_attachments.call_args[0]
+        self.assertEqual(failing_checks, [])
+        self.assertIn(u'Graphs: [ES Metric Check](', attachments[0]['text'])
+        self.assertEqual(attachments[0]['actions'][0]['name'], 'Show graph: ES Metric Check')
+
+    @patch('cabot_alert_mattermost.models.MatterMostAlert._add_users_to_channel')
+    @patch('cabot_alert_mattermost.models.MatterMostAlert._send_alert')
+    def test_send_alerts(self, send_alert, add_users):
+        self.service.overall_status = Service.ERROR_STATUS
+        self.service.old_overall_status = Service.PASSING_STATUS
+        other_service = Service.objects.create(name='Other service', mattermost_instance=self.mm_instance)
+        other_service.overall_status = Service.ERROR_STATUS
+        other_service.old_overall_status = Service.PASSING_STATUS
+        quiet_service = Service.objects.create(name='Quiet service', mattermost_instance=self.mm_instance)
+        quiet_service.overall_status = Service.PASSING_STATUS
+        quiet_service.old_overall_status = Service.ACKED_STATUS
+
+        groups = self.plugin.render_alerts([(self.service, [self.user]), (other_service, [self.user]),
+                                            (quiet_service, [self.user])])
+        self.assertEqual(list(groups), [(self.mm_instance.id, 'better-channel'),
+                                        (self.mm_instance.id, 'default-channel')])
+        self.assertEqual([r.service for r in groups[(self.mm_instance.id, 'default-channel')]], [other_service])
+
+        self.plugin.send_alerts([(self.service, [self.user]), (other_service, [self.user]),
+                                 (quiet_service, [self.user])])
+        # users are added once per channel
+        self.assertEqual(add_users.call_args_list, [
+            call('https://mattermost.org/api/v4/', {'Authorization': 'Bearer SOME-TOKEN'}, 'better-channel',
+                 ['testuser_alias', 'cabot'], client=models._get_mm_client(self.service)),
+            call('https://mattermost.org/api/v4/', {'Authorization': 'Bearer SOME-TOKEN'}, 'default-channel',
+                 ['testuser_alias', 'cabot'], client=models._get_mm_client(self.service)),
+        ])
+        self.assertEqual([c[0][0] for c in send_alert.call_args_list], [self.service, other_service])
+
+        # and the messages are the same as send_alert's
+        batch_message = send_alert.call_args_list[0][0][1]
+        send_alert.reset_mock()
+        self.plugin.send_alert(self.service, [self.user], [])
+        self.assertEqual(send_alert.call_args[0][1], batch_message)
+
+    @patch('cabot_alert_mattermost.models.tasks.replay_outbox')
+    @patch('cabot_alert_mattermost.client.MatterMostClient.post')
+    @patch('cabot_alert_mattermost.models.MatterMostAlert._add_users_to_channel')
+    @patch('cabot_alert_mattermost.models.MatterMostAlert._upload_files')
+    def test_outbox(self, upload_files, add_users, post, replay_outbox):
+        upload_files.return_value = []
+        post.side_effect = client.MatterMostUnavailable('Mattermost is down')
+        self.service.old_overall_status = Service.PASSING_STATUS
+        self.service.overall_status = Service.ERROR_STATUS
+        self.assertRaises(client.MatterMostUnavailable, self.plugin.send_alert, self.service, [self.user], [])
+        self.service.old_overall_status = Service.ERROR_STATUS
+        self.service.overall_status = Service.ACKED_STATUS
+        self.assertRaises(client.MatterMostUnavailable, self.plugin.send_alert, self.service, [self.user], [])
+
+        # only the latest status is kept, and every failure schedules a replay
+        outbox_post = models.MatterMostOutboxPost.objects.get()
+        self.assertEqual(json.loads(outbox_post.payload)['props']['attachments'][0]['fallback'], 'Service is ACKED')
+        self.assertEqual(replay_outbox.apply_async.call_args_list, [call(countdown=models.OUTBOX_RETRY_BACKOFF)] * 2)
+
+        # nothing is due yet
+        post.reset_mock()
+        post.side_effect = None
+        post.return_value = Mock(status_code=201)
+        self.assertIsNotNone(self.plugin.replay_outbox())
+        self.assertFalse(post.called)
+
+        # failures are retried later
+        models.MatterMostOutboxPost.objects.update(next_attempt=timezone.now())
+        post.side_effect = requests.ConnectionError()
+        self.assertGreater(self.plugin.replay_outbox(), models.OUTBOX_RETRY_BACKOFF)
+        self.assertEqual(models.MatterMostOutboxPost.objects.get().attempts, 1)
+
+        models.MatterMostOutboxPost.objects.update(next_attempt=timezone.now())
+        post.side_effect = None
+        self.assertIsNone(self.plugin.replay_outbox())
+        self.assertEqual(post.call_args,
+                         call('posts', essential=True, idempotent=False, json=json.loads(outbox_post.payload)))
+        self.assertFalse(models.MatterMostOutboxPost.objects.exists())
+
+    @patch('cabot_alert_mattermost.models.tasks.replay_outbox')
+    @patch('cabot_alert_mattermost.client.MatterMostClient.post')
+    @patch('cabot_alert_mattermost.models.MatterMostAlert._add_users_to_channel')
+    @patch('cabot_alert_mattermost.models.MatterMostAlert._upload_files')
+    def test_outbox_post_is_superseded(self, upload_files, add_users, post, replay_outbox):
+        upload_files.return_value = []
+        post.side_effect = client.MatterMostUnavailable('Mattermost is down')
+        self.service.old_overall_status = Service.PASSING_STATUS
+        self.service.overall_status = Service.ERROR_STATUS
+        self.assertRaises(client.MatterMostUnavailable, self.plugin.send_alert, self.service, [self.user], [])
+        outbox_post = models.MatterMostOutboxPost.objects.get()
+
+        # Mattermost recovers and the recovery is posted directly, so the stale ERROR post is never replayed
+        post.side_effect = None
+        post.return_value = Mock(status_code=201, json=lambda: {'id': 'post-id'})
+        self.service.old_overall_status = Service.ERROR_STATUS
+        self.service.overall_status = Service.PASSING_STATUS
+        self.plugin.send_alert(self.service, [self.user], [])
+        self.assertFalse(models.MatterMostOutboxPost.objects.exists())
+
+        # even if a replay had already claimed it
+        post.reset_mock()
+        self.assertEqual(self.plugin._replay_outbox_post(outbox_post), 'superseded')
+        self.assertFalse(post.called)
+
+    @patch('cabot_alert_mattermost.models.tasks.replay_outbox')
+    def test_outbox_is_bounded(self, replay_outbox):
+        with patch('cabot_alert_mattermost.models.OUTBOX_MAX_SIZE', 2):
+            for i in range(3):
+                models._save_to_outbox(self.mm_instance, [], {'channel_id': 'better-channel', 'message': str(i)},
+                                       client.MatterMostUnavailable())
+        self.assertEqual([json.loads(p.payload)['message'] for p in models.MatterMostOutboxPost.objects.order_by('id')],
+                         ['1', '2'])
+
+    @patch('cabot_alert_mattermost.models.tasks.replay_outbox')
+    def test_outbox_posts_about_several_services(self, replay_outbox):
+        other_service = Service.objects.create(name='Other service', mattermost_instance=self.mm_instance,
+                                               mattermost_channel_id='better-channel')
+
+        def save(services, message):
+            models._save_to_outbox(self.mm_instance, services, {'channel_id': 'better-channel', 'message': message},
+                                   client.MatterMostUnavailable())
+
+        def messages():
+            return [json.loads(p.payload)['message'] for p in models.MatterMostOutboxPost.objects.order_by('id')]
+
+        # e.g. coalesced alerts or digests: a post about both services replaces older posts about either one
+        save([self.service], 'service')
+        save([other_service], 'other')
+        save([self.service, other_service], 'both')
+        self.assertEqual(messages(), ['both'])
+
+        # a newer post about one of them doesn't drop news about the other
+        save([self.service], 'service again')
+        self.assertEqual(messages(), ['both', 'service again'])
+
+        # a post that goes out supersedes them the same way
+        models._supersede_outbox_posts('better-channel', [self.service, other_service])
+        self.assertEqual(messages(), [])
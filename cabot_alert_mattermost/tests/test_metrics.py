@@ -0,0 +1,54 @@
+from unittest import TestCase
+
+from cabot_alert_mattermost import metrics
+from cabot_alert_mattermost.cache import TTLCache
+from cabot_alert_mattermost.client import MatterMostClient
+
+
+class TestMetrics(TestCase):
+    def setUp(self):
+        self.backend = metrics.InMemoryBackend()
+        metrics.set_backend(self.backend)
+
+    def tearDown(self):
+        metrics.set_backend(metrics.NullBackend())
+
+    def test_counters_and_stages_are_recorded_for_the_current_alert(self):
+        with metrics.alert_timer('service') as timer:
+            metrics.incr('upload.bytes', 100)
+            metrics.incr('upload.bytes', 50)
+            with metrics.stage('render'):
+                pass
+            timer.outcome = 'sent'
+
+        self.assertEqual(timer.counters, {'upload_bytes': 150})
+        self.assertEqual(list(timer.stages), ['render'])
+        self.assertEqual(self.backend.counters, {'mattermost.upload.bytes': 150})
+        self.assertEqual(len(self.backend.timings['mattermost.stage.render']), 1)
+        self.assertEqual(len(self.backend.timings['mattermost.alert.sent']), 1)
+        self.assertIn('alert="service" outcome=sent', timer.summary())
+        self.assertIn('upload_bytes=150', timer.summary())
+        self.assertIsNone(metrics.current_alert())
+
+    def test_failed_alert(self):
+        with self.assertRaises(ValueError):
+            with metrics.alert_timer('service') as timer:
+                raise ValueError()
+        self.assertEqual(timer.outcome, 'failed')
+        self.assertIn('mattermost.alert.failed', self.backend.timings)
+
+    def test_worker_threads_record_to_the_alert(self):
+        c = MatterMostClient('https://mattermost.org/api/v4/', {}, max_concurrency=3)
+        try:
+            with metrics.alert_timer('service') as timer:
+                c.map(lambda x: metrics.incr('things'), [1, 2, 3])
+        finally:
+            c.close()
+        self.assertEqual(timer.counters, {'things': 3})
+
+    def test_named_cache_reports_hits_and_misses(self):
+        cache = TTLCache(10, 60, name='users')
+        cache.set('a', 1)
+        cache.get('a')
+        cache.get('b')
+        self.assertEqual(self.backend.counters, {'mattermost.cache.users.hits': 1, 'mattermost.cache.users.misses': 1})
@@ -0,0 +1,8 @@
+from django.conf.urls import url
+
+from cabot_alert_mattermost import views
+
+urlpatterns = [
+    url(r'^status-image/(?P<check_id>\d+)/$', views.status_image, name='mattermost-status-image'),
+    url(r'^status-image/action/$', views.status_image_action, name='mattermost-status-image-action'),
+]
@@ -0,0 +1,76 @@
+"""
+Endpoints for lazy status images (see MatterMostInstanceSettings.lazy_images).
+Requests are authenticated with the token the plugin signed when it posted the alert, which expires after
+STATUS_IMAGE_LINK_TTL.
+"""
+import json
+import logging
+import time
+
+import requests
+from django.core.exceptions import PermissionDenied
+from django.http import HttpResponse, HttpResponseBadRequest, HttpResponseForbidden, Http404, JsonResponse
+from django.shortcuts import get_object_or_404
+from django.utils.crypto import constant_time_compare
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_GET, require_POST
+
+from cabot.cabotapp.models import StatusCheck
+from cabot.cabotapp.models_plugins import MatterMostInstance
+from cabot_alert_mattermost.models import MatterMostAlert, STATUS_IMAGE_CACHE_TIMEOUT, _get_cached_status_image, _sign
+
+logger = logging.getLogger(__name__)
+
+
+@require_GET
+def status_image(request, check_id):
+    """The 'Graphs' links: serve a check's status image."""
+    try:
+        expires = int(request.GET.get('expires', ''))
+    except ValueError:
+        return HttpResponseForbidden()
+    if not constant_time_compare(request.GET.get('token', ''), _sign('link', check_id, expires)) or \
+            expires < time.time():
+        return HttpResponseForbidden()
+    image = _get_cached_status_image(get_object_or_404(StatusCheck, id=check_id))
+    if image is None:
+        raise Http404('This check has no status image.')
+    response = HttpResponse(image[1], content_type='image/png')
+    response['Cache-Control'] = 'private, max-age={}'.format(STATUS_IMAGE_CACHE_TIMEOUT)
+    return response
+
+
+@csrf_exempt
+@require_POST
+def status_image_action(request):
+    """
+    The 'Show graph' buttons: Mattermost calls this when one is clicked (see
+    https://developers.mattermost.com/integrate/plugins/interactive-messages/), and we post the check's status image
+    in the alert's thread. Only works in the channel the alert was posted in.
+    """
+    try:
+        payload = json.loads(request.body)
+        context = payload['context']
+        instance_id, check_id = int(context['instance_id']), int(context['check_id'])
+        channel_id, expires = context['channel_id'], int(context['expires'])
+        post_id = payload['post_id']
+    except (ValueError, TypeError, KeyError):
+        return HttpResponseBadRequest()
+    token = _sign('action', instance_id, check_id, channel_id, expires)
+    if not constant_time_compare(context.get('token', ''), token) or payload.get('channel_id') != channel_id:
+        return HttpResponseForbidden()
+    if expires < time.time():
+        return JsonResponse({'ephemeral_text': u'This alert is too old to show graphs for.'})
+
+    instance = get_object_or_404(MatterMostInstance, id=instance_id)
+    check = get_object_or_404(StatusCheck, id=check_id)
+    try:
+        MatterMostAlert.objects.get().post_status_image(instance, channel_id, post_id, check)
+    except PermissionDenied:
+        logger.warn('Refusing to post the status image of check %s to post %s, it is not in channel %s.',
+                    check_id, post_id, channel_id)
+        return HttpResponseForbidden()
+    except requests.RequestException:
+        logger.exception('Could not post the status image of check %s to post %s.', check_id, post_id)
+        return JsonResponse({'ephemeral_text': u'Could not post the graph for {}.'.format(check.name)})
+    return JsonResponse({})